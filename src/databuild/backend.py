@@ -19,6 +19,15 @@ class GeneDocBackendBase:
         '''update only, no upsert.'''
         raise NotImplemented
 
+    def update_bulk(self, id_doc_li):
+        '''update multiple docs from a list of (id, extra_doc) tuples.
+           return a tuple of the number of updated docs and a list of _ids
+           failed to update.
+        '''
+        for id, extra_doc in id_doc_li:
+            self.update(id, extra_doc)
+        return len(id_doc_li), []
+
     def drop(self):
         raise NotImplemented
 
@@ -28,6 +37,10 @@ class GeneDocBackendBase:
     def get_from_id(self, id):
         raise NotImplemented
 
+    def sorted_doc_feeder(self, step=10000, fields=None):
+        '''iterate all docs in _id order.'''
+        raise NotImplemented
+
     def finalize(self):
         '''if needed, for example for bulk updates, perform flush
            at the end of updating.
@@ -95,31 +108,144 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
         #                                      {'$unset': {'temp_padding': ''}},
         #                                      check_keys=False, w=0)
 
+    def _get_set_updates(self, extra_doc):
+        '''"$set" extra_doc, and unset "_hash" (see utils.common.get_doc_hash)
+           unless it is set as well, since the doc is changed.
+        '''
+        _updates = {'$set': extra_doc}
+        if '_hash' not in extra_doc:
+            _updates['$unset'] = {'_hash': ''}
+        return _updates
+
     def update(self, id, extra_doc):
         '''if id does not exist in the target_collection,
             the update will be ignored.
         '''
-        self.target_collection.update({'_id': id}, {'$set': extra_doc},
+        self.target_collection.update({'_id': id}, self._get_set_updates(extra_doc),
                                       manipulate=False, check_keys=False,
                                       upsert=False, w=0)
 
-    def update_diff(self, diff, extra={}):
-        '''update a doc based on the diff returned from diff.diff_doc
-            "extra" can be passed (as a dictionary) to add common fields to the
-            updated doc, e.g. a timestamp.
+    def update_bulk(self, id_doc_li):
+        '''send all updates in id_doc_li, a list of (id, extra_doc) tuples, as
+           one unordered bulk operation. Like update, no upsert. Empty
+           extra_docs are skipped, and a failed update does not abort the rest.
+           return a tuple of the number of matched docs and a list of _ids
+           failed to update.
         '''
+        id_li = []
+        bulk = self.target_collection.initialize_unordered_bulk_op()
+        for id, extra_doc in id_doc_li:
+            if extra_doc:
+                bulk.find({'_id': id}).update_one(self._get_set_updates(extra_doc))
+                id_li.append(id)
+        if not id_li:
+            return 0, []
+        res, failed_li = self._execute_bulk(bulk, id_li)
+        return res['nMatched'], failed_li
+
+    def _get_diff_updates(self, diff, extra={}):
         _updates = {}
-        _add_d = dict(diff.get('add', {}).items() + diff.get('update', {}).items())
+        _add_d = dict(list(diff.get('add', {}).items()) + list(diff.get('update', {}).items()))
         if _add_d or extra:
             if extra:
                 _add_d.update(extra)
             _updates['$set'] = _add_d
         if diff.get('delete', None):
             _updates['$unset'] = dict([(x, 1) for x in diff['delete']])
+        return _updates
+
+    def update_diff(self, diff, extra={}):
+        '''update a doc based on the diff returned from diff.diff_doc
+            "extra" can be passed (as a dictionary) to add common fields to the
+            updated doc, e.g. a timestamp.
+            dotted paths from a deep diff are set/unset in place.
+        '''
+        _updates = self._get_diff_updates(diff, extra)
         self.target_collection.update({'_id': diff['_id']}, _updates,
                                       manipulate=False, check_keys=False,
                                       upsert=False, w=0)
 
+    def _execute_bulk(self, bulk, id_li):
+        '''execute a bulk operation with acknowledged writes. id_li are the _ids
+           of the operations in order. return the result and a list of _ids
+           whose operation failed.
+        '''
+        from pymongo.errors import BulkWriteError
+        try:
+            return bulk.execute({'w': 1}), []
+        except BulkWriteError as e:
+            return e.details, [id_li[err['index']] for err in e.details['writeErrors']]
+
+    def _get_existing_ids(self, id_li):
+        return set([doc['_id'] for doc in self.target_collection.find({'_id': {'$in': id_li}}, fields=[])])
+
+    def insert_bulk(self, doc_li):
+        '''insert docs with an acknowledged write, continuing on errors. Unlike
+           a bulk operation, keys are not checked, as in insert, so docs with
+           dotted keys can be added.
+           return a list of _ids failed to insert (e.g. duplicated _ids).
+        '''
+        from pymongo.errors import PyMongoError
+        from bson.errors import InvalidDocument
+        existing_set = self._get_existing_ids([doc['_id'] for doc in doc_li])
+        failed_li = [doc['_id'] for doc in doc_li if doc['_id'] in existing_set]
+        new_doc_li = [doc for doc in doc_li if doc['_id'] not in existing_set]
+        if new_doc_li:
+            try:
+                self.target_collection.insert(new_doc_li, manipulate=False, check_keys=False,
+                                              continue_on_error=True, w=1)
+            except (PyMongoError, InvalidDocument) as e:
+                print('\tinsert failed: {}'.format(e))
+                id_li = [doc['_id'] for doc in new_doc_li]
+                inserted_set = self._get_existing_ids(id_li)
+                failed_li.extend([_id for _id in id_li if _id not in inserted_set])
+        return failed_li
+
+    def update_diff_bulk(self, diff_li, extra={}):
+        '''same as update_diff, but all diffs are sent as one unordered,
+           acknowledged bulk operation. return a list of _ids failed to update.
+           If less docs are matched than expected, all _ids in diff_li are
+           returned, since it is unknown which docs are missing.
+           Diffs setting values with dotted keys (see
+           utils.common.diff_has_dotted_key) are not sent, and their _ids are
+           returned as failed, those docs should be replaced (see replace_bulk).
+        '''
+        from utils.common import diff_has_dotted_key
+        skipped_li = [diff['_id'] for diff in diff_li if diff_has_dotted_key(diff)]
+        diff_li = [diff for diff in diff_li if not diff_has_dotted_key(diff)]
+        if not diff_li:
+            return skipped_li
+        bulk = self.target_collection.initialize_unordered_bulk_op()
+        for diff in diff_li:
+            bulk.find({'_id': diff['_id']}).update_one(self._get_diff_updates(diff, extra))
+        id_li = [diff['_id'] for diff in diff_li]
+        res, failed_li = self._execute_bulk(bulk, id_li)
+        if res['nMatched'] + len(failed_li) < len(diff_li):
+            return skipped_li + id_li
+        return skipped_li + failed_li
+
+    def replace_bulk(self, doc_li):
+        '''replace docs by their _ids, by removing and inserting them again, so
+           that docs with dotted keys (rejected by Mongo in updates) can be
+           written as well. return a list of _ids failed to replace.
+        '''
+        id_li = [doc['_id'] for doc in doc_li]
+        failed_li = self.remove_bulk(id_li)
+        if failed_li:
+            return failed_li
+        return self.insert_bulk(doc_li)
+
+    def remove_bulk(self, ids):
+        '''remove docs matching ids with an acknowledged write. return ids if
+           not all of them are removed, otherwise an empty list.
+        '''
+        bulk = self.target_collection.initialize_unordered_bulk_op()
+        bulk.find({'_id': {'$in': ids}}).remove()
+        res, failed_li = self._execute_bulk(bulk, [ids])    # a single remove op for all ids
+        if failed_li or res['nRemoved'] < len(ids):
+            return list(ids)
+        return []
+
     def drop(self):
         self.target_collection.drop()
 
@@ -129,17 +255,37 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
     def get_from_id(self, id):
         return self.target_collection.get_from_id(id)
 
-    def mget_from_ids(self, ids, asiter=False):
+    def sorted_doc_feeder(self, step=10000, fields=None):
+        '''iterate all docs in _id order, "fields" is an optional list of fields
+           to return ("_id" is always returned).
+        '''
+        cur = self.target_collection.find(fields=fields, manipulate=False, timeout=False).sort('_id', 1)
+        cur.batch_size(step)
+        try:
+            for doc in cur:
+                yield doc
+        finally:
+            cur.close()
+
+    def mget_from_ids(self, ids, asiter=False, step=10000, fields=None):
         '''ids is an id list.
            returned doc list should be in the same order of the
              input ids. non-existing ids are ignored.
+           ids are queried in batches of "step", to stay under the BSON size
+           limit, and only one batch of docs is buffered to restore the order,
+           so with asiter=True, docs are streamed from a generator.
+           "fields" is an optional list of fields to return ("_id" is always returned).
         '''
-        #this does not return doc in the same order of ids
-        cur = self.target_collection.find({'_id': {'$in': ids}})
-        _d = dict([(d['_id'], d) for d in cur])
-        doc_li = [_d[_id] for _id in ids if _id in _d]
-        del _d
-        return iter(doc_li) if asiter else doc_li
+        def _mget():
+            for i in range(0, len(ids), step):
+                _ids = ids[i:i + step]
+                #this does not return doc in the same order of ids
+                cur = self.target_collection.find({'_id': {'$in': _ids}}, fields=fields, manipulate=False)
+                _d = dict([(d['_id'], d) for d in cur])
+                for _id in _ids:
+                    if _id in _d:
+                        yield _d[_id]
+        return _mget() if asiter else list(_mget())
 
         ## This following query can perserve the order of ids, but too slow
         #cur = self.target_collection.find({'$or': [{'_id': _id} for _id in ids]})
@@ -220,7 +366,7 @@ class GeneDocESBackend(GeneDocBackendBase):
         self.target_esidxer.optimize()
 
     def get_id_list(self):
-        return self.target_esidxer.get_id_list()
+        return self.target_esidxer.get_id_list_parallel(verbose=False)
 
     def get_from_id(self, id):
         return self.target_esidxer.get(id)
@@ -229,9 +375,25 @@ class GeneDocESBackend(GeneDocBackendBase):
         # index_type = self.target_esidxer.ES_INDEX_TYPE
         # return conn.get(index_name, index_type, id)
 
-    def mget_from_ids(self, ids, step=100000):
-        '''ids is an id list. always return a generator'''
-        return self.target_esidxer.get_docs(ids, step=step)
+    def sorted_doc_feeder(self, step=10000, fields=None):
+        '''iterate all docs in _id order, "fields" is an optional list of fields
+           to return ("_id" is always returned).
+        '''
+        return self.target_esidxer.sorted_doc_feeder(step=step, fields=fields)
+
+    def update_diff_bulk(self, diff_li, extra={}):
+        '''apply diffs returned from diff.diff_doc (including dotted paths from
+           a deep diff) as partial updates. return a list of _ids failed to update.
+        '''
+        return self.target_esidxer.update_docs_from_diffs(diff_li, extra=extra)
+
+    def mget_from_ids(self, ids, asiter=True, step=100000, fields=None):
+        '''ids is an id list. return a generator, or a list if asiter is False.
+           None is returned for non-existing ids.
+           "fields" is an optional list of fields to return ("_id" is always returned).
+        '''
+        docs = self.target_esidxer.get_docs(ids, step=step, fields=fields)
+        return docs if asiter else list(docs)
 
     def remove_from_ids(self, ids, step=10000):
         self.target_esidxer.delete_docs(ids, step=step)
@@ -1,22 +1,41 @@
 from __future__ import print_function
 import sys
 import os.path
+import shutil
 import time
 import copy
+import heapq
+import tempfile
+import threading
+from operator import itemgetter
+from optparse import OptionParser
 from datetime import datetime
 from pprint import pprint
+from bson import BSON
 
 if sys.version_info.major == 2:
     input = raw_input
-
-from utils.mongo import (get_src_db, get_target_db, get_src_master,
-                         get_src_build, get_src_dump, doc_feeder)
-from utils.common import (loadobj, timesofar, safewfile, LogPrint, ask,
-                          dump2gridfs, get_timestamp, get_random_string)
-from utils.dataload import list2dict, alwayslist
+    import cPickle as pickle
+    import Queue as queue
+else:
+    import pickle
+    import queue
+
+from utils.mongo import (get_src_conn, get_src_db, get_target_db, get_src_master,
+                         get_src_build, get_src_dump, doc_feeder, doc_feeder_by_ids,
+                         id_range_partition, id_range_query)
+from utils.common import (loadobj, timesofar, safewfile, LogPrint, ask, is_str,
+                          dump2gridfs, get_timestamp, get_random_string, get_peak_rss_mb,
+                          get_doc_hash, iter_n, reraise)
+from utils.dataload import alwayslist
 from utils.es import ESIndexer
+from utils.idmapping import IdMapping, GeneIdSet
 import databuild.backend
 from config import LOG_FOLDER
+try:
+    from config import IDMAPPING_FOLDER
+except ImportError:
+    IDMAPPING_FOLDER = tempfile.gettempdir()
 
 '''
 #Build_Config example
@@ -62,16 +81,30 @@ class DataBuilder():
         self.src = get_src_db()
         self.step = 10000
         self.use_parallel = False
+        self.use_bulk = True          # merge sources using unordered bulk writes.
+        self.bulk_max_docs = 1000     # flush pending bulk updates after this many updates,
+        self.bulk_max_bytes = 8 * 1024 * 1024    # or after this many (BSON-encoded) bytes.
+        self.checkpoint_every = 10    # save a merging checkpoint after this many bulk writes, 0 to disable.
+        self.merge_workers = 1        # if > 1, merge each source with this many local processes.
+        self.use_pipeline = False     # overlap source reads and target writes in separate threads.
+        self.pipeline_queue_size = 4  # max no. of batches queued between pipeline stages.
+        self.use_sortmerge = False    # build target in one pass with a sort-merge join.
+        self.sortmerge_run_size = 200000    # max no. of docs sorted in memory before spilling to disk.
+        self.sortmerge_tmp_folder = None    # folder for spilled runs, default is system temp folder.
+        self.taxid_pushdown_exclude = ['entrez_homologene']    # sources whose "taxid" is not the gene's species.
+        self.id_pushdown_ratio = 0.2  # read a source by root gene ids if there are fewer than this ratio of its docs.
         self.merge_logging = True     # save output into a logging file when merge is called.
         self.max_build_status = 10    # max no. of records kept in "build" field of src_build collection.
 
         self.using_ipython_cluster = False
         self.shutdown_ipengines_after_done = False
         self.log_folder = LOG_FOLDER
+        self.idmapping_folder = IDMAPPING_FOLDER    # local folder for memory-mapped idmapping files.
 
         self._build_config = build_config
         self._entrez_geneid_d = None
         self._idmapping_d_cache = {}
+        self._stage_stats = {}
 
         self.get_src_master()
 
@@ -115,6 +148,14 @@ class DataBuilder():
             _cfg['build'][-1].update(dict)
             src_build.update({'_id': self._build_config['_id']}, {"$set": {'build': _cfg['build']}})
 
+    def log_stage_stats(self, stage, stats):
+        '''record the metrics of a build stage ("root", "idmapping", or a source
+           name) into "stage_stats" of current build record, with peak RSS so far.
+        '''
+        stats['peak_rss_mb'] = get_peak_rss_mb()
+        self._stage_stats[stage] = stats
+        self.log_src_build({'stage_stats': self._stage_stats})
+
     def log_building_start(self):
         if self.merge_logging:
             #setup logging
@@ -123,13 +164,15 @@ class DataBuilder():
             log_f, logfile = safewfile(os.path.join(self.log_folder, logfile), prompt=False, default='O')
             sys.stdout = LogPrint(log_f, timestamp=True)
 
+        self._stage_stats = {}
         src_build = getattr(self, 'src_build', None)
         if src_build:
             #src_build.update({'_id': self._build_config['_id']}, {"$unset": {"build": ""}})
             d = {'status': 'building',
                  'started_at': datetime.now(),
                  'logfile': logfile,
-                 'target_backend': self.target.name}
+                 'target_backend': self.target.name,
+                 'src_timestamp': self.get_src_timestamp()}
             if self.target.name == 'mongodb':
                 d['target'] = self.target.target_collection.name
             elif self.target.name == 'es':
@@ -140,6 +183,7 @@ class DataBuilder():
             if len(_cfg['build']) > self.max_build_status:
                 #remove the first build status record
                 src_build.update({'_id': self._build_config['_id']}, {"$pop": {'build': -1}})
+                self._remove_geneid_set(_cfg['build'][0])
 
     def _get_target_name(self):
         return 'genedoc_{}_{}_{}'.format(self._build_config['name'],
@@ -178,14 +222,29 @@ class DataBuilder():
         self._entrez_geneid_d = loadobj(("entrez_gene__geneid_d.pyobj", self.src), mode='gridfs')
 
     def _load_ensembl2entrez_li(self):
+        t0 = time.time()
         ensembl2entrez_li = loadobj(("ensembl_gene__2entrezgene_list.pyobj", self.src), mode='gridfs')
+        t1 = time.time()
+        cnt_read = len(ensembl2entrez_li)
         #filter out those deprecated entrez gene ids
         print(len(ensembl2entrez_li))
         ensembl2entrez_li = [(ensembl_id, self._entrez_geneid_d[int(entrez_id)]) for (ensembl_id, entrez_id) in ensembl2entrez_li
                              if int(entrez_id) in self._entrez_geneid_d]
         print(len(ensembl2entrez_li))
-        ensembl2entrez = list2dict(ensembl2entrez_li, 0)
+        t2 = time.time()
+        #build a compact, memory-mapped idmapping, shared by all worker processes.
+        idmapping_file = os.path.join(self.idmapping_folder, 'ensembl_gene__2entrezgene.idmap')
+        ensembl2entrez = IdMapping.build(ensembl2entrez_li, idmapping_file)
         self._idmapping_d_cache['ensembl_gene'] = ensembl2entrez
+        t3 = time.time()
+        self.log_stage_stats('idmapping', {'docs_read': cnt_read,
+                                           'docs_matched': len(ensembl2entrez_li),
+                                           'docs_written': len(ensembl2entrez),
+                                           'bytes': os.path.getsize(idmapping_file),
+                                           'read_time': round(t1 - t0, 1),
+                                           'transform_time': round(t2 - t1, 1),
+                                           'write_time': round(t3 - t2, 1),
+                                           'time_in_s': round(t3 - t0, 1)})
 
     def _save_idmapping_gridfs(self):
         '''saving _idmapping_d_cache into gridfs.'''
@@ -193,11 +252,24 @@ class DataBuilder():
         if self._idmapping_d_cache:
             for id_type in self._idmapping_d_cache:
                 filename = 'tmp_idmapping_d_cache_' + id_type
-                dump2gridfs(self._idmapping_d_cache[id_type], filename, self.src)
+                #ipengine nodes cannot map local files, so send a plain dictionary.
+                dump2gridfs(self._idmapping_d_cache[id_type].todict(), filename, self.src)
                 idmapping_gridfs_d[id_type] = filename
         return idmapping_gridfs_d
 
-    def make_genedoc_root(self):
+    def make_genedoc_root(self, insert_fn=None):
+        '''insert root genedocs into the target and return geneid_set.
+           optional "insert_fn" receives each list of root docs instead of self.target.insert.
+        '''
+        _insert_fn = insert_fn or self.target.insert
+        root_stats = {'docs_read': 0, 'docs_written': 0, 'read_time': 0, 'write_time': 0}
+
+        def insert_fn(doc_li):
+            t0 = time.time()
+            _insert_fn(doc_li)
+            root_stats['docs_written'] += len(doc_li)
+            root_stats['write_time'] += time.time() - t0
+
         if not self._entrez_geneid_d:
             self._load_entrez_geneid_d()
 
@@ -205,20 +277,17 @@ class DataBuilder():
             self._load_ensembl2entrez_li()
             ensembl2entrez = self._idmapping_d_cache['ensembl_gene']
 
-        if "species" in self._build_config:
-            _query = {'taxid': {'$in': self._build_config['species']}}
-        elif "species_to_exclude" in self._build_config:
-            _query = {'taxid': {'$nin': self._build_config['species_to_exclude']}}
-        else:
-            _query = None
+        _query = self.get_species_query()
 
-        geneid_set = []
+        t0 = time.time()
+        geneid_set = GeneIdSet()
         species_set = set()
         if "entrez_gene" in self._build_config['gene_root']:
-            for doc_li in doc_feeder(self.src['entrez_gene'], inbatch=True, step=self.step, query=_query):
+            for doc_li in _timed_iter(doc_feeder(self.src['entrez_gene'], inbatch=True, step=self.step, query=_query), root_stats):
+                root_stats['docs_read'] += len(doc_li)
                 #target_collection.insert(doc_li, manipulate=False, check_keys=False)
-                self.target.insert(doc_li)
-                geneid_set.extend([doc['_id'] for doc in doc_li])
+                insert_fn(doc_li)
+                geneid_set.update([doc['_id'] for doc in doc_li])
                 species_set |= set([doc['taxid'] for doc in doc_li])
             cnt_total_entrez_genes = len(geneid_set)
             cnt_total_species = len(species_set)
@@ -228,7 +297,8 @@ class DataBuilder():
         if "ensembl_gene" in self._build_config['gene_root']:
             cnt_ensembl_only_genes = 0
             cnt_total_ensembl_genes = 0
-            for doc_li in doc_feeder(self.src['ensembl_gene'], inbatch=True, step=self.step, query=_query):
+            for doc_li in _timed_iter(doc_feeder(self.src['ensembl_gene'], inbatch=True, step=self.step, query=_query), root_stats):
+                root_stats['docs_read'] += len(doc_li)
                 _doc_li = []
                 for _doc in doc_li:
                     cnt_total_ensembl_genes += 1
@@ -238,16 +308,15 @@ class DataBuilder():
                         #this is an Ensembl only gene
                         _doc_li.append(_doc)
                         cnt_ensembl_only_genes += 1
-                        geneid_set.append(_doc['_id'])
+                        geneid_set.add(_doc['_id'])
                 if _doc_li:
                     #target_collection.insert(_doc_li, manipulate=False, check_keys=False)
-                    self.target.insert(_doc_li)
+                    insert_fn(_doc_li)
             cnt_matching_ensembl_genes = cnt_total_ensembl_genes - cnt_ensembl_only_genes
             print('# of ensembl Gene IDs in total: %d' % cnt_total_ensembl_genes)
             print('# of ensembl Gene IDs match entrez Gene IDs: %d' % cnt_matching_ensembl_genes)
             print('# of ensembl Gene IDs DO NOT match entrez Gene IDs: %d' % cnt_ensembl_only_genes)
 
-            geneid_set = set(geneid_set)
             print('# of total Root Gene IDs: %d' % len(geneid_set))
             _stats = {'total_entrez_genes': cnt_total_entrez_genes,
                       'total_species': cnt_total_species,
@@ -258,8 +327,44 @@ class DataBuilder():
             self._stats = _stats
             self._src_version = self.get_src_version()
             self.log_src_build({'stats': _stats, 'src_version': self._src_version})
+            self._save_geneid_set(geneid_set)
+
+            t = time.time() - t0
+            root_stats.update({'docs_matched': len(geneid_set),
+                               'read_time': round(root_stats['read_time'], 1),
+                               'write_time': round(root_stats['write_time'], 1),
+                               'transform_time': round(t - root_stats['read_time'] - root_stats['write_time'], 1),
+                               'time_in_s': round(t, 1)})
+            self.log_stage_stats('root', root_stats)
             return geneid_set
 
+    def _save_geneid_set(self, geneid_set):
+        '''save geneid_set into gridfs, so that merge_resume does not need to
+           re-scan the target for root gene ids.
+        '''
+        if getattr(self, 'src_build', None):
+            filename = 'geneid_set__' + self.target.target_name
+            dump2gridfs(geneid_set, filename, self.src)
+            self.log_src_build({'geneid_set': filename})
+
+    def _load_geneid_set(self, build):
+        '''return geneid_set saved for the given build record, or re-create it
+           from the ids in current target if it is not available.
+        '''
+        filename = build.get('geneid_set', None)
+        if filename:
+            print('Loading geneid_set from "{}"...'.format(filename))
+            return loadobj((filename, self.src), mode='gridfs')
+        else:
+            print('Re-creating geneid_set from target...')
+            return GeneIdSet(self.target.get_id_list())
+
+    def _remove_geneid_set(self, build):
+        import gridfs
+        filename = build.get('geneid_set', None)
+        if filename:
+            gridfs.GridFS(self.src).delete(filename)
+
     def get_idmapping_d(self, src):
         if src in self._idmapping_d_cache:
             return self._idmapping_d_cache[src]
@@ -268,13 +373,29 @@ class DataBuilder():
             return self._idmapping_d_cache[src]
             #raise ValueError('cannot load "idmapping_d" for "%s"' % src)
 
-    def merge(self, step=100000, restart_at=0):
+    def merge(self, step=100000, restart_at=0, incremental=False):
+        '''if incremental is True, only sources changed since last successful
+           build are merged again into a copy of the last target, see
+           get_sources_to_remerge. Otherwise, the target is built from scratch.
+        '''
         t0 = time.time()
         self.validate_src_collections()
+        if incremental:
+            last_build = self.get_last_success_build()
+            src_to_remerge = self.get_sources_to_remerge(last_build) if last_build else None
+            if src_to_remerge is None:
+                print("Incremental build is not possible, build from scratch instead.")
+                incremental = False
+            else:
+                print("Sources to re-merge: {}".format(', '.join(src_to_remerge) or 'none'))
         self.log_building_start()
         try:
-            if self.using_ipython_cluster:
+            if incremental:
+                self._merge_incremental(last_build, src_to_remerge, step=step)
+            elif self.using_ipython_cluster:
                 self._merge_ipython_cluster(step=step)
+            elif self.use_sortmerge:
+                self._merge_sortmerge()
             else:
                 self._merge_local(step=step, restart_at=restart_at)
 
@@ -302,9 +423,12 @@ class DataBuilder():
             if self.merge_logging:
                 sys.stdout.close()
 
-    def merge_resume(self, build_config, at_collection, step=10000):
+    def merge_resume(self, build_config, at_collection=None, step=10000):
         '''resume a merging process after a failure.
              .merge_resume('mygene_allspecies', 'reporter')
+           if at_collection is None, resume from the last checkpoint saved in
+           the build record, right after the last merged batch.
+             .merge_resume('mygene_allspecies')
         '''
         assert not self.using_ipython_cluster, "Abort. Can only resume merging in non-parallel mode."
         self.load_build_config(build_config)
@@ -313,27 +437,44 @@ class DataBuilder():
         pprint(last_build)
         assert last_build['status'] == 'building', \
             "Abort. Last build does not need to be resumed."
-        assert at_collection in self._build_config['sources'], \
+        src_collection_list = [collection for collection in self._build_config['sources']
+                               if collection not in ['entrez_gene', 'ensembl_gene']]
+        start_after = None
+        if at_collection is None:
+            checkpoint = last_build.get('checkpoint', None)
+            assert checkpoint, \
+                'Abort. No checkpoint available, specify the collection to resume merging from.'
+            if checkpoint.get('done', False):
+                _idx = src_collection_list.index(checkpoint['source']) + 1
+            else:
+                _idx = src_collection_list.index(checkpoint['source'])
+                start_after = checkpoint['last_id']
+            at_collection = src_collection_list[_idx] if _idx < len(src_collection_list) else None
+        assert at_collection is None or at_collection in src_collection_list, \
             'Abort. Cannot resume merging from a unknown collection "{}"'.format(at_collection)
         assert last_build['target_backend'] == self.target.name, \
             'Abort. Re-initialized DataBuilder class using matching backend "{}"'.format(last_build['backend'])
         assert last_build.get('stats', None), \
             'Abort. Intital build stats are not available. You should restart the build from the scratch.'
         self._stats = last_build['stats']
+        # keep stats of the stages done before the failure, so that they are
+        # not overwritten by the stages merged after resuming.
+        self._stage_stats = copy.deepcopy(last_build.get('stage_stats', {}))
 
-        if ask('Continue to resume merging from "{}"?'.format(at_collection)) == 'Y':
+        if start_after is not None:
+            _prompt = 'Continue to resume merging from "{}" after _id "{}"?'.format(at_collection, start_after)
+        else:
+            _prompt = 'Continue to resume merging from "{}"?'.format(at_collection or '<finalizing>')
+        if ask(_prompt) == 'Y':
             #TODO: resume logging
             target_name = last_build['target']
             self.validate_src_collections()
             self.prepare_target(target_name=target_name)
-            src_cnt = 0
-            for collection in self._build_config['sources']:
-                if collection in ['entrez_gene', 'ensembl_gene']:
-                    continue
-                src_cnt += 1
-                if collection == at_collection:
-                    break
-            self._merge_local(step=step, restart_at=src_cnt)
+            if at_collection:
+                src_cnt = src_collection_list.index(at_collection) + 1
+            else:
+                src_cnt = len(src_collection_list) + 1
+            self._merge_local(step=step, restart_at=src_cnt, start_after=start_after)
             if self.target.name == 'es':
                 print("Updating metadata...", end=' ')
                 self.update_mapping_meta()
@@ -431,7 +572,7 @@ class DataBuilder():
                         __id = str(__id)
                         doc.pop('_id', None)
                         doc.pop('taxid', None)
-                        target_collection.update({'_id': __id}, {'$set': doc},
+                        target_collection.update({'_id': __id}, {'$set': doc, '$unset': {'_hash': ''}},
                                                  manipulate=False,
                                                  upsert=False)
             finally:
@@ -465,7 +606,11 @@ class DataBuilder():
             lview.shutdown()
             print('Done.')
 
-    def _merge_local(self, step=100000, restart_at=0):
+    def _merge_local(self, step=100000, restart_at=0, start_after=None):
+        '''if restart_at > 0, skip the first restart_at - 1 sources (excluding root
+           sources). if start_after is given as well, the restart_at source is
+           merged from the docs with _id greater than start_after.
+        '''
         if restart_at == 0:
             self.target.drop()
             self.target.prepare()
@@ -474,7 +619,7 @@ class DataBuilder():
             if not self._entrez_geneid_d:
                 self._load_entrez_geneid_d()
             #geneid_set = set([x['_id'] for x in target_collection.find(fields=[], manipulate=False)])
-            geneid_set = set(self.target.get_id_list())
+            geneid_set = self._load_geneid_set(self._build_config.get('build', [{}])[-1])
             print('\t', len(geneid_set))
 
         src_collection_list = self._build_config['sources']
@@ -484,25 +629,116 @@ class DataBuilder():
                 continue
 
             src_cnt += 1
+            if restart_at <= src_cnt:
+                _start_after = start_after if src_cnt == restart_at else None
+                _stats = self._merge_source(collection, geneid_set, step=step, start_after=_start_after)
+                if _stats:
+                    self.log_stage_stats(collection, _stats)
+        self.stamp_doc_hash()
+        self.target.finalize()
 
-            id_type = self.src_master[collection].get('id_type', None)
-            flag_need_id_conversion = id_type is not None
-            if flag_need_id_conversion:
-                idmapping_d = self.get_idmapping_d(id_type)
-            else:
-                idmapping_d = None
+    def _merge_sortmerge(self):
+        '''build the target in one pass: root docs and the docs from all sources
+           are sorted by their (mapped) target _id, then k-way merged in memory,
+           so that every genedoc is inserted fully assembled, exactly once.
+           Fields from later sources override earlier ones, in the same order
+           as _merge_local does.
+        '''
+        self.target.drop()
+        self.target.prepare()
+        tmp_folder = tempfile.mkdtemp(prefix='databuild_sortmerge_', dir=self.sortmerge_tmp_folder)
+        try:
+            root_sorter = _ExternalSorter(tmp_folder, run_size=self.sortmerge_run_size)
 
-            if restart_at <= src_cnt:
-                if self.use_parallel:
-                    self.doc_queue = []
-                    self._merge_parallel_ipython(collection, geneid_set,
-                                                 step=step, idmapping_d=idmapping_d)
-                else:
-                    self._merge_sequential(collection, geneid_set,
-                                           step=step, idmapping_d=idmapping_d)
+            def _add_root_docs(doc_li):
+                for doc in doc_li:
+                    root_sorter.add(doc['_id'], doc)
+            geneid_set = self.make_genedoc_root(insert_fn=_add_root_docs)
+            root_sorter.finish()
+
+            sorter_li = [root_sorter]
+            for collection in self._build_config['sources']:
+                if collection in ['entrez_gene', 'ensembl_gene']:
+                    continue
+                id_type = self.src_master[collection].get('id_type', None)
+                idmapping_d = self.get_idmapping_d(id_type) if id_type else None
+                sorter = _ExternalSorter(tmp_folder, run_size=self.sortmerge_run_size)
+                t1 = time.time()
+                # read in _id order, as _merge_sequential_bulk does, so that docs mapped
+                # to the same target _id are applied in the same order.
+                doc_iter, read_stats = self._get_src_doc_feeder(collection, geneid_set, step=self.step)
+                read_stats.update({'docs_read': 0, 'read_time': 0})
+                _sort_src_docs(sorter, doc_iter, geneid_set, idmapping_d, read_stats)
+                print('"{}": {} docs to merge.'.format(collection, sorter.cnt))
+                sorter_li.append(sorter)
+                t = time.time() - t1
+                read_stats.update({'docs_matched': sorter.cnt,
+                                   'read_time': round(read_stats['read_time'], 1),
+                                   'transform_time': round(t - read_stats['read_time'], 1),
+                                   'time_in_s': round(t, 1)})
+                self.log_stage_stats(collection, read_stats)
+
+            print("Merging and inserting genedocs...")
+            t0 = time.time()
+            cnt = 0
+            write_time = 0
+            doc_li = []
+            for genedoc in _sortmerge_docs(sorter_li):
+                genedoc['_hash'] = get_doc_hash(genedoc)
+                doc_li.append(genedoc)
+                if len(doc_li) >= self.step:
+                    t1 = time.time()
+                    self.target.insert(doc_li)
+                    write_time += time.time() - t1
+                    cnt += len(doc_li)
+                    doc_li = []
+            if doc_li:
+                t1 = time.time()
+                self.target.insert(doc_li)
+                write_time += time.time() - t1
+                cnt += len(doc_li)
+            print("Done. [{} genedocs inserted, {}]".format(cnt, timesofar(t0)))
+            t = time.time() - t0
+            self.log_stage_stats('sortmerge', {'docs_read': sum([sorter.cnt for sorter in sorter_li]),
+                                               'docs_written': cnt,
+                                               'write_time': round(write_time, 1),
+                                               'transform_time': round(t - write_time, 1),
+                                               'time_in_s': round(t, 1)})
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
         self.target.finalize()
 
+    def _merge_source(self, collection, geneid_set, step=100000, start_after=None):
+        '''merge one source collection into the target, return merging stats if available.
+           if start_after is given, only docs with _id greater than it are merged.
+        '''
+        id_type = self.src_master[collection].get('id_type', None)
+        flag_need_id_conversion = id_type is not None
+        if flag_need_id_conversion:
+            idmapping_d = self.get_idmapping_d(id_type)
+        else:
+            idmapping_d = None
+
+        if start_after is not None:
+            assert self.use_bulk and self.merge_workers == 1 and not self.use_parallel, \
+                "Abort. Can only resume merging from a checkpoint in sequential bulk mode."
+            return self._merge_sequential_bulk(collection, geneid_set, step=step,
+                                               idmapping_d=idmapping_d, start_after=start_after)
+        if self.merge_workers > 1:
+            return self._merge_parallel(collection, geneid_set,
+                                        step=step, idmapping_d=idmapping_d)
+        elif self.use_parallel:
+            self.doc_queue = []
+            self._merge_parallel_ipython(collection, geneid_set,
+                                         step=step, idmapping_d=idmapping_d)
+        else:
+            return self._merge_sequential(collection, geneid_set,
+                                          step=step, idmapping_d=idmapping_d)
+
     def _merge_sequential(self, collection, geneid_set, step=100000, idmapping_d=None):
+        if self.use_bulk:
+            return self._merge_sequential_bulk(collection, geneid_set,
+                                               step=step, idmapping_d=idmapping_d)
         for doc in doc_feeder(self.src[collection], step=step):
             _id = doc['_id']
             if idmapping_d:
@@ -517,42 +753,212 @@ class DataBuilder():
                     #                           upsert=False) #,safe=True)
                     self.target.update(__id, doc)
 
-    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from multiprocessing import Process, Queue
-        NUMBER_OF_PROCESSES = 8
-
-        input_queue = Queue()
-        input_queue.conn_pool = []
-
-        def worker(q, target):
-            while True:
-                doc = q.get()
-                if doc == 'STOP':
-                    break
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target.update(__id, doc)
-                # target_collection.update({'_id': __id}, {'$set': doc},
-                #                           manipulate=False,
-                #                           upsert=False) #,safe=True)
-
-        # Start worker processes
-        for i in range(NUMBER_OF_PROCESSES):
-            Process(target=worker, args=(input_queue, self.target)).start()
+    def get_species_query(self):
+        '''return the query on "taxid" for the species set in build config, or None.'''
+        if "species" in self._build_config:
+            return {'taxid': {'$in': self._build_config['species']}}
+        elif "species_to_exclude" in self._build_config:
+            return {'taxid': {'$nin': self._build_config['species_to_exclude']}}
+
+    def get_src_pushdown(self, collection, geneid_set):
+        '''decide how reads from a (non-root) source collection can be restricted
+           to the species in build config. return a tuple of:
+              ('taxid', query)    source docs carry "taxid", read docs matching query.
+              ('id', id_li)       read docs by the sorted list of root gene ids.
+              (None, None)        read all docs.
+        '''
+        species_query = self.get_species_query()
+        if not species_query:
+            return None, None
+        src_collection = self.src[collection]
+        if collection not in self.taxid_pushdown_exclude and \
+           src_collection.find_one({'taxid': {'$exists': True}}, fields=['taxid']):
+            if '$in' in species_query['taxid']:
+                # docs without "taxid" are still merged, as they are now.
+                return 'taxid', {'$or': [species_query, {'taxid': {'$exists': False}}]}
+            else:
+                return 'taxid', species_query    # "$nin" matches docs without "taxid" too.
+        if not self.src_master[collection].get('id_type', None) and \
+           len(geneid_set) < src_collection.count() * self.id_pushdown_ratio:
+            sample = src_collection.find_one(fields=[])
+            if sample and not is_str(sample['_id']):
+                id_li = sorted([int(_id) for _id in geneid_set if _id.isdigit()])
+            else:
+                id_li = sorted(geneid_set)
+            return 'id', id_li
+        return None, None
+
+    def _get_src_doc_feeder(self, collection, geneid_set, step=100000, start_after=None):
+        '''return an iterator of docs from a source collection in _id order,
+           with the species filter pushed down into the source query when
+           possible (see get_src_pushdown), and a dictionary of read stats,
+           where "docs_skipped" is set after the iterator is exhausted.
+        '''
+        pushdown, arg = self.get_src_pushdown(collection, geneid_set)
+        stats = {'pushdown': pushdown,
+                 'docs_total': self.src[collection].count()}
+
+        def _feeder():
+            cnt = 0
+            if pushdown == 'id':
+                doc_iter = doc_feeder_by_ids(self.src[collection], arg, step=min(step, self.step), start_after=start_after)
+            else:
+                query = arg
+                if start_after is not None:
+                    _query = {'_id': {'$gt': start_after}}
+                    query = {'$and': [query, _query]} if query else _query
+                doc_iter = doc_feeder(self.src[collection], step=step, query=query, sort=[('_id', 1)])
+            for doc in doc_iter:
+                cnt += 1
+                yield doc
+            if start_after is None:
+                stats['docs_skipped'] = stats['docs_total'] - cnt
+                if pushdown:
+                    print('"{}": {} of {} docs skipped by "{}" pushdown.'.format(
+                          collection, stats['docs_skipped'], stats['docs_total'], pushdown))
+        return _feeder(), stats
+
+    def _merge_sequential_bulk(self, collection, geneid_set, step=100000, idmapping_d=None, start_after=None):
+        '''same as _merge_sequential, but "$set" updates are accumulated and sent
+           to the target as unordered bulk writes. Pending updates are flushed
+           when either self.bulk_max_docs or self.bulk_max_bytes is reached.
+           Source docs are read in _id order, and after every
+           self.checkpoint_every bulk writes, a checkpoint is saved into the
+           build record, so that merge_resume can continue with the docs
+           after "start_after" _id.
+           return a dictionary of merging stats for this source collection.
+        '''
+        t0 = time.time()
+        doc_iter, read_stats = self._get_src_doc_feeder(collection, geneid_set, step=step, start_after=start_after)
+
+        def _checkpoint(last_id, stats):
+            if self.checkpoint_every and stats['batches'] % self.checkpoint_every == 0:
+                self._save_checkpoint(collection, last_id, stats)
+
+        if self.use_pipeline:
+            stats = _merge_docs_pipelined(doc_iter, self.target, geneid_set, idmapping_d=idmapping_d,
+                                          max_docs=self.bulk_max_docs,
+                                          max_bytes=self.bulk_max_bytes,
+                                          batch_callback=_checkpoint,
+                                          queue_size=self.pipeline_queue_size)
+        else:
+            stats = _merge_docs_bulk(doc_iter, self.target, geneid_set, idmapping_d=idmapping_d,
+                                     max_docs=self.bulk_max_docs,
+                                     max_bytes=self.bulk_max_bytes,
+                                     batch_callback=_checkpoint)
+        stats.update(read_stats)
+        if self.checkpoint_every:
+            self._save_checkpoint(collection, None, stats, done=True)
+        t = time.time() - t0
+        stats['time_in_s'] = round(t, 1)
+        stats['docs_per_sec'] = round(stats['docs_read'] / t, 1) if t > 0 else 0
+        _round_stage_times(stats)
+        print('"{}": {} docs read, {} docs updated, {} failed, {} docs/sec [{}]'.format(
+              collection, stats['docs_read'], stats['docs_written'], stats['docs_failed'],
+              stats['docs_per_sec'], timesofar(t0)))
+        return stats
+
+    def stamp_doc_hash(self):
+        '''set "_hash" of genedocs in the target (see utils.common.get_doc_hash),
+           so that diff can compare docs by their hashes first. Only docs without
+           "_hash" are stamped: merge updates unset it on every doc they change
+           (see GeneDocMongoDBBackend.update_bulk), so an incremental build
+           re-stamps only the docs touched by the re-merged sources.
+        '''
+        if self.target.name != 'mongodb':
+            return
+        print('Stamping "_hash" of genedocs...')
+        t0 = time.time()
+        stats = _new_merge_stats()
+
+        def _hash_updates():
+            doc_iter = doc_feeder(self.target.target_collection, step=self.step,
+                                  query={'_hash': {'$exists': False}}, sort=[('_id', 1)])
+            for doc in _timed_iter(doc_iter, stats):
+                t1 = time.time()
+                stats['docs_read'] += 1
+                _update = (doc['_id'], {'_hash': get_doc_hash(doc)})
+                stats['transform_time'] += time.time() - t1
+                yield _update
+
+        for batch in iter_n(_hash_updates(), self.bulk_max_docs):
+            _write_bulk_batch(self.target, list(batch), 0, stats)
+        t = time.time() - t0
+        stats['time_in_s'] = round(t, 1)
+        _round_stage_times(stats)
+        print('Done. [{} genedocs stamped, {}]'.format(stats['docs_written'], timesofar(t0)))
+        self.log_stage_stats('hash', stats)
+
+    def _save_checkpoint(self, collection, last_id, stats, done=False):
+        '''save the merging progress of a source into the build record.'''
+        checkpoint = {'source': collection,
+                      'last_id': last_id,
+                      'done': done,
+                      'docs_read': stats['docs_read'],
+                      'docs_written': stats['docs_written'],
+                      'docs_failed': stats['docs_failed'],
+                      'batches': stats['batches'],
+                      'timestamp': datetime.now()}
+        self.log_src_build({'checkpoint': checkpoint})
 
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    input_queue.put(doc)
+    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
+        '''merge a source collection using self.merge_workers local processes.
+           The source collection is split into _id ranges, each worker process
+           opens its own Mongo connection and merges one range at a time with
+           bulk writes. return a dictionary of merging stats for this source.
+        '''
+        from multiprocessing import Pool
+        global _merge_worker_context
+        assert self.target.name == 'mongodb', 'Parallel merging requires "mongodb" backend.'
 
-        # Tell child processes to stop
-        for i in range(NUMBER_OF_PROCESSES):
-            input_queue.put('STOP')
+        t0 = time.time()
+        # worker processes are forked after this point, so they inherit
+        # geneid_set and idmapping_d (a memory-mapped IdMapping, shared
+        # zero-copy) without pickling them.
+        _merge_worker_context = {'geneid_set': geneid_set,
+                                 'idmapping_d': idmapping_d}
+        pushdown, query = self.get_src_pushdown(collection, geneid_set)
+        if pushdown != 'taxid':
+            query = None    # reading by root gene ids does not split into _id ranges.
+        range_li = id_range_partition(self.src[collection], self.merge_workers * 4, query=query)
+        task_li = [{'src_collection': collection,
+                    'query': query,
+                    'target_collection': self.target.target_collection.name,
+                    'start': start,
+                    'end': end,
+                    'step': min(step, self.step),
+                    'max_docs': self.bulk_max_docs,
+                    'max_bytes': self.bulk_max_bytes} for (start, end) in range_li]
+        print('"{}": merging {} _id ranges with {} workers...'.format(collection, len(task_li), self.merge_workers))
+        stats = _new_merge_stats()    # times are summed over all workers.
+        pool = Pool(processes=self.merge_workers)
+        try:
+            for i, res in enumerate(pool.imap_unordered(_merge_worker, task_li)):
+                print('\tworker {pid}: [{start}, {end}) {docs_read} docs read, '
+                      '{docs_written} docs updated [{time}] ({0}/{1})'.format(i + 1, len(task_li), **res))
+                for k in stats:
+                    stats[k] += res[k]
+                stats['failed_ids'] = stats['failed_ids'][:MAX_FAILED_IDS]
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _merge_worker_context = None
+
+        t = time.time() - t0
+        stats['time_in_s'] = round(t, 1)
+        stats['docs_per_sec'] = round(stats['docs_read'] / t, 1) if t > 0 else 0
+        stats['workers'] = self.merge_workers
+        _round_stage_times(stats)
+        stats['pushdown'] = 'taxid' if query else None
+        stats['docs_total'] = self.src[collection].count()
+        stats['docs_skipped'] = stats['docs_total'] - stats['docs_read']
+        print('"{}": {} docs read, {} docs updated, {} failed, {} docs/sec [{}]'.format(
+              collection, stats['docs_read'], stats['docs_written'], stats['docs_failed'],
+              stats['docs_per_sec'], timesofar(t0)))
+        return stats
 
     def _merge_parallel_ipython(self, collection, geneid_set, step=100000, idmapping_d=None):
         from IPython.parallel import Client, require
@@ -612,6 +1018,260 @@ class DataBuilder():
                 src_version[src['_id']] = version
         return src_version
 
+    def get_src_timestamp(self):
+        '''return the timestamps of source collections in current build config,
+           as recorded in src_master when each source was uploaded.
+        '''
+        return dict([(src, self.src_master[src].get('timestamp', None))
+                     for src in self._build_config['sources']])
+
+    def get_last_success_build(self, build_config=None):
+        '''return the record of last successful build from src_build collection.
+           default is current build config, or pass another build config name.
+        '''
+        src_build = getattr(self, 'src_build', None)
+        if src_build:
+            _cfg = src_build.find_one({'_id': build_config or self._build_config['_id']}) or {}
+            for build in reversed(_cfg.get('build', [])):
+                if build.get('status', None) == 'success':
+                    return build
+
+    def _get_src_fields(self, src):
+        mapping = self.src_master[src].get('mapping', None)
+        if mapping:
+            return set(mapping)
+
+    def get_sources_to_remerge(self, last_build):
+        '''compare the timestamp of each source in src_master with the one recorded
+           in last_build, return a list of sources need to be re-merged, in the
+           order of build config. Return None if an incremental build is not
+           possible, e.g. the root sources changed, or the fields populated by a
+           changed source cannot be determined from its mapping.
+
+           Besides the changed sources, any other source populating one of the
+           same fields is re-merged too, so that fields overridden by a later
+           source are still overridden after the incremental build.
+        '''
+        root_li = ['entrez_gene', 'ensembl_gene']
+        if last_build.get('target_backend', None) != 'mongodb' or self.target.name != 'mongodb':
+            return None
+        last_src_timestamp = last_build.get('src_timestamp', None)
+        if last_src_timestamp and set(last_src_timestamp) != set(self._build_config['sources']):
+            print("Build sources have changed since last build.")
+            return None
+
+        changed_set = set()
+        for src in self._build_config['sources']:
+            _timestamp = self.src_master[src].get('timestamp', None)
+            if last_src_timestamp:
+                _changed = _timestamp is None or _timestamp != last_src_timestamp[src]
+            else:
+                # build records before "src_timestamp" was recorded
+                _changed = _timestamp is None or _timestamp >= last_build['started_at']
+            if _changed:
+                if src in root_li:
+                    print('Root source "{}" has changed.'.format(src))
+                    return None
+                changed_set.add(src)
+
+        src_fields = {}
+        for src in self._build_config['sources']:
+            src_fields[src] = self._get_src_fields(src)
+            if src_fields[src] is None and src not in root_li:
+                print('Cannot get fields from the mapping of source "{}".'.format(src))
+                return None
+
+        remerge_set = set(changed_set)
+        while True:
+            fields = set()
+            for src in remerge_set:
+                fields |= src_fields[src]
+            _remerge_set = set([src for src in src_fields
+                                if src_fields[src] and src_fields[src] & fields])
+            if _remerge_set & set(root_li):
+                print("Changed sources share fields with root sources.")
+                return None
+            if _remerge_set <= remerge_set:
+                break
+            remerge_set |= _remerge_set
+        return [src for src in self._build_config['sources'] if src in remerge_set]
+
+    def _merge_incremental(self, last_build, src_li, step=100000):
+        '''build the target from the target of last_build: clone it on the server,
+           unset the fields of all sources in src_li, and merge them again.
+        '''
+        last_target = get_target_db()[last_build['target']]
+        target_collection = self.target.target_collection
+        print('Cloning "{}" into "{}"...'.format(last_target.name, target_collection.name), end='')
+        t0 = time.time()
+        self.target.drop()
+        last_target.aggregate([{'$match': {}}, {'$out': target_collection.name}])
+        print('Done. [{}]'.format(timesofar(t0)))
+        self.target.prepare()
+
+        fields = set()
+        for src in src_li:
+            fields |= self._get_src_fields(src)
+        if fields:
+            print('Unsetting {} fields from "{}"...'.format(len(fields), ', '.join(src_li)), end='')
+            t0 = time.time()
+            target_collection.update({'$or': [{field: {'$exists': True}} for field in sorted(fields)]},
+                                     {'$unset': dict([(field, 1) for field in fields] + [('_hash', 1)])},
+                                     multi=True)
+            print('Done. [{}]'.format(timesofar(t0)))
+
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        geneid_set = self._load_geneid_set(last_build)
+        self._stats = last_build['stats']
+        self._src_version = self.get_src_version()
+        self.log_src_build({'stats': self._stats,
+                            'src_version': self._src_version,
+                            'incremental_from': last_build['target'],
+                            'remerged_sources': src_li})
+        self._save_geneid_set(geneid_set)
+
+        for collection in src_li:
+            _stats = self._merge_source(collection, geneid_set, step=step)
+            if _stats:
+                self.log_stage_stats(collection, _stats)
+        self.stamp_doc_hash()
+        self.target.finalize()
+
+    def check_derivable(self, parent_config):
+        '''return None if current build config can be derived from the last
+           successful build of "parent_config" (see derive), otherwise a
+           message of the reason why not.
+        '''
+        if self.target.name != 'mongodb':
+            return 'Derived build requires "mongodb" backend.'
+        parent_cfg = self.src_build.find_one({'_id': parent_config})
+        if not parent_cfg:
+            return 'Cannot find build config named "{}".'.format(parent_config)
+        if parent_cfg['sources'] != self._build_config['sources'] or \
+           parent_cfg['gene_root'] != self._build_config['gene_root']:
+            return 'Build config "{}" has different sources from "{}".'.format(self._build_config['_id'],
+                                                                              parent_config)
+        parent_build = self.get_last_success_build(parent_config)
+        if not parent_build or parent_build.get('target_backend', None) != 'mongodb':
+            return 'No successful "mongodb" build available for "{}".'.format(parent_config)
+
+    def derive(self, parent_config, use_parallel=False):
+        '''materialize current build config from the last successful build of
+           "parent_config" (e.g. "mygene_allspecies"), by copying the genedocs
+           matching the species in current build config, instead of merging
+           all sources again. Both build configs must have the same sources
+           and root sources. The copy is done on the server with "$out", or
+           by self.merge_workers local processes if use_parallel is True.
+        '''
+        t0 = time.time()
+        error = self.check_derivable(parent_config)
+        assert not error, 'Abort. ' + (error or '')
+        parent_build = self.get_last_success_build(parent_config)
+
+        self.prepare_target()
+        self.log_building_start()
+        try:
+            parent_target = get_target_db()[parent_build['target']]
+            query = self.get_species_query()
+            print('Deriving "{}" from "{}"...'.format(self.target.target_name, parent_target.name))
+            self.target.drop()
+            if use_parallel and self.merge_workers > 1:
+                copy_stats = self._copy_target_parallel(parent_target, query)
+            else:
+                t1 = time.time()
+                parent_target.aggregate([{'$match': query or {}}, {'$out': self.target.target_name}])
+                copy_stats = {'time_in_s': round(time.time() - t1, 1)}
+                print('Done. [{}]'.format(timesofar(t1)))
+            self.target.prepare()
+
+            geneid_set = GeneIdSet(self.target.get_id_list())
+            cnt_ensembl_only_genes = self.target.target_collection.find({'_id': {'$regex': '^[^0-9]'}}).count()
+            _stats = {'total_entrez_genes': len(geneid_set) - cnt_ensembl_only_genes,
+                      'total_species': len(self.target.target_collection.distinct('taxid')),
+                      'total_ensembl_only_genes': cnt_ensembl_only_genes,
+                      'total_genes': len(geneid_set)}
+            self._stats = _stats
+            # genedocs are merged from the sources of the parent build.
+            self._src_version = parent_build.get('src_version', None)
+            self.log_src_build({'stats': _stats,
+                                'src_version': self._src_version,
+                                'src_timestamp': parent_build.get('src_timestamp', None),
+                                'derived_from': {'build_config': parent_config,
+                                                 'target': parent_target.name,
+                                                 'stats': parent_build.get('stats', None)}})
+            copy_stats['docs_written'] = len(geneid_set)
+            self.log_stage_stats('copy', copy_stats)
+            self._save_geneid_set(geneid_set)
+            self.target.finalize()
+
+            self.log_src_build({'status': 'success',
+                                'time': timesofar(t0),
+                                'time_in_s': round(time.time() - t0, 0),
+                                'timestamp': datetime.now()})
+            print('"{}": {} genedocs derived from "{}".'.format(self.target.target_name,
+                                                              _stats['total_genes'], parent_target.name))
+        finally:
+            if self.merge_logging:
+                sys.stdout.close()
+
+    def _copy_target_parallel(self, parent_target, query=None):
+        '''copy genedocs matching query from parent_target into current target,
+           split into _id ranges copied by self.merge_workers local processes.
+        '''
+        from multiprocessing import Pool
+        t0 = time.time()
+        range_li = id_range_partition(parent_target, self.merge_workers * 4, query=query)
+        task_li = [{'src_collection': parent_target.name,
+                    'target_collection': self.target.target_name,
+                    'query': query,
+                    'start': start,
+                    'end': end,
+                    'step': self.step} for (start, end) in range_li]
+        print('copying {} _id ranges with {} workers...'.format(len(task_li), self.merge_workers))
+        stats = {'docs_written': 0}
+        pool = Pool(processes=self.merge_workers)
+        try:
+            for i, res in enumerate(pool.imap_unordered(_copy_worker, task_li)):
+                print('\tworker {pid}: [{start}, {end}) {docs_written} docs copied [{time}] ({0}/{1})'.format(
+                      i + 1, len(task_li), **res))
+                stats['docs_written'] += res['docs_written']
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        stats['time_in_s'] = round(time.time() - t0, 1)
+        stats['workers'] = self.merge_workers
+        return stats
+
+    def print_build_stats(self, build_config=None, n=5,
+                          metrics=('time_in_s', 'docs_read', 'docs_written', 'docs_failed', 'read_time', 'write_time',
+                                   'peak_rss_mb')):
+        '''print "stage_stats" of the last n build records of a build config side
+           by side, one table per metric, the most recent build last.
+             .print_build_stats('mygene_allspecies', 5)
+        '''
+        _cfg = get_src_build().find_one({'_id': build_config or self._build_config['_id']})
+        build_li = _cfg.get('build', [])[-n:]
+        stage_li = ['root', 'idmapping', 'copy'] + \
+                   [src for src in _cfg['sources'] if src not in ['entrez_gene', 'ensembl_gene']] + ['sortmerge', 'hash']
+        stage_li = [stage for stage in stage_li
+                    if any([stage in build.get('stage_stats', {}) for build in build_li])]
+        header = '{:<30}'.format('stage') + ''.join(['{:>16}'.format(build['started_at'].strftime('%Y-%m-%d %H:%M'))
+                                                     for build in build_li])
+        for metric in metrics:
+            print('== {} =='.format(metric))
+            print(header)
+            for stage in stage_li:
+                print('{:<30}'.format(stage) + ''.join(['{:>16}'.format(build.get('stage_stats', {}).get(stage, {}).get(metric, '-'))
+                                                        for build in build_li]))
+            if metric == 'time_in_s':
+                print('{:<30}'.format('<total>') + ''.join(['{:>16}'.format(build.get('time_in_s', '-'))
+                                                            for build in build_li]))
+            print()
+
     def get_last_src_build_stats(self):
         src_build = getattr(self, 'src_build', None)
         if src_build:
@@ -855,18 +1515,452 @@ class DataBuilder():
         return changes
 
 
+MAX_FAILED_IDS = 100    # max no. of _ids of failed writes kept in merging stats
+
+
+def _new_merge_stats():
+    return {'docs_read': 0, 'docs_matched': 0, 'docs_written': 0, 'bytes': 0, 'batches': 0,
+            'read_time': 0, 'transform_time': 0, 'write_time': 0,
+            'docs_failed': 0, 'failed_ids': []}
+
+
+def _round_stage_times(stats):
+    for k in ('read_time', 'transform_time', 'write_time'):
+        if k in stats:
+            stats[k] = round(stats[k], 1)
+
+
+def _timed_iter(iterable, stats, key='read_time'):
+    '''iterate iterable, adding the time spent on getting each item into stats[key].'''
+    it = iter(iterable)
+    while True:
+        t0 = time.time()
+        try:
+            item = next(it)
+        except StopIteration:
+            stats[key] += time.time() - t0
+            return
+        stats[key] += time.time() - t0
+        yield item
+
+
+def _iter_bulk_batches(doc_iter, geneid_set, idmapping_d=None, max_docs=1000, max_bytes=8*1024*1024,
+                       stats=None):
+    '''map docs from doc_iter to target _ids in geneid_set, and group them into
+       batches of (_id, doc) pairs for target.update_bulk. yield tuples of
+       (batch, batch_bytes, last_id), where last_id is the _id of the last
+       source doc in the batch. "docs_read", "docs_matched" and "transform_time"
+       in optional "stats" are updated.
+    '''
+    stats = stats if stats is not None else _new_merge_stats()
+    pending = []
+    pending_bytes = 0
+    src_id = None
+    for doc in doc_iter:
+        t0 = time.time()
+        stats['docs_read'] += 1
+        _id = src_id = doc['_id']
+        if idmapping_d:
+            _id = idmapping_d.get(_id, None) or _id
+        doc_size = None
+        for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+            __id = str(__id)
+            if __id in geneid_set:
+                doc.pop('_id', None)
+                doc.pop('taxid', None)
+                if doc_size is None:
+                    doc_size = len(BSON.encode(doc))
+                pending.append((__id, doc))
+                pending_bytes += doc_size
+                stats['docs_matched'] += 1
+        stats['transform_time'] += time.time() - t0
+        # flush only after all target ids of a source doc are queued,
+        # so that a batch always ends at a source doc boundary.
+        if len(pending) >= max_docs or pending_bytes >= max_bytes:
+            yield pending, pending_bytes, src_id
+            pending = []
+            pending_bytes = 0
+    if pending:
+        yield pending, pending_bytes, src_id
+
+
+def _write_bulk_batch(target, batch, batch_bytes, stats):
+    t0 = time.time()
+    cnt, failed_li = target.update_bulk(batch)
+    stats['docs_written'] += cnt
+    if failed_li:
+        stats['docs_failed'] += len(failed_li)
+        stats['failed_ids'].extend(failed_li[:MAX_FAILED_IDS - len(stats['failed_ids'])])
+    stats['write_time'] += time.time() - t0
+    stats['bytes'] += batch_bytes
+    stats['batches'] += 1
+
+
+def _merge_docs_bulk(doc_iter, target, geneid_set, idmapping_d=None, max_docs=1000, max_bytes=8*1024*1024,
+                     batch_callback=None):
+    '''merge docs from doc_iter into target backend using target.update_bulk.
+       batch_callback is an optional function as fn(last_id, stats), called after
+       every bulk write, where last_id is the _id of the last source doc written.
+       return a dictionary of merging stats.
+    '''
+    stats = _new_merge_stats()
+    doc_iter = _timed_iter(doc_iter, stats)
+    for batch, batch_bytes, last_id in _iter_bulk_batches(doc_iter, geneid_set, idmapping_d,
+                                                          max_docs, max_bytes, stats=stats):
+        _write_bulk_batch(target, batch, batch_bytes, stats)
+        if batch_callback:
+            batch_callback(last_id, stats)
+    return stats
+
+
+_PIPELINE_DONE = object()    # marks the end of items in a pipeline queue
+
+
+def _pipeline_put(q, item, stop):
+    '''put item into a bounded queue, return False if the pipeline is stopped first.'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _pipeline_get(q, stop):
+    '''get an item from a queue, return _PIPELINE_DONE if the pipeline is stopped first.'''
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+    return _PIPELINE_DONE
+
+
+def _merge_docs_pipelined(doc_iter, target, geneid_set, idmapping_d=None, max_docs=1000, max_bytes=8*1024*1024,
+                          batch_callback=None, queue_size=4):
+    '''same as _merge_docs_bulk, but run as a three-stage pipeline, so that source
+       reads and target writes overlap:
+           reader thread:   prefetches docs from doc_iter in chunks of max_docs.
+           calling thread:  maps ids and groups docs into bulk batches.
+           writer thread:   sends batches to target, calls batch_callback.
+       Stages are connected by queues holding at most "queue_size" items, so
+       memory use stays bounded. Batches are written in order, so a checkpoint
+       saved by batch_callback is still valid: the writer passes it the stats
+       read up to the end of the batch, not those of the batches read ahead.
+       An exception raised in any stage stops the whole pipeline and is
+       re-raised here with its original traceback.
+    '''
+    stats = _new_merge_stats()
+    read_q = queue.Queue(queue_size)
+    write_q = queue.Queue(queue_size)
+    stop = threading.Event()
+    error_li = []
+
+    def _reader():
+        try:
+            chunk = []
+            for doc in _timed_iter(doc_iter, stats):
+                chunk.append(doc)
+                if len(chunk) >= max_docs:
+                    if not _pipeline_put(read_q, chunk, stop):
+                        return
+                    chunk = []
+            if chunk:
+                _pipeline_put(read_q, chunk, stop)
+        except Exception:
+            error_li.append(sys.exc_info())
+            stop.set()
+        finally:
+            _pipeline_put(read_q, _PIPELINE_DONE, stop)
+
+    def _writer():
+        try:
+            while True:
+                item = _pipeline_get(write_q, stop)
+                if item is _PIPELINE_DONE:
+                    return
+                batch, batch_bytes, last_id, read_stats = item
+                _write_bulk_batch(target, batch, batch_bytes, stats)
+                if batch_callback:
+                    _stats = dict(stats)
+                    _stats.update(read_stats)
+                    batch_callback(last_id, _stats)
+        except Exception:
+            error_li.append(sys.exc_info())
+            stop.set()
+
+    def _read_docs():
+        while True:
+            chunk = _pipeline_get(read_q, stop)
+            if chunk is _PIPELINE_DONE:
+                return
+            for doc in chunk:
+                yield doc
+
+    thread_li = [threading.Thread(target=_reader, name='merge-reader'),
+                 threading.Thread(target=_writer, name='merge-writer')]
+    for t in thread_li:
+        t.daemon = True
+        t.start()
+    try:
+        for batch, batch_bytes, last_id in _iter_bulk_batches(_read_docs(), geneid_set, idmapping_d,
+                                                              max_docs, max_bytes, stats=stats):
+            # snapshot the read counters together with last_id for checkpoints
+            read_stats = {'docs_read': stats['docs_read'],
+                          'docs_matched': stats['docs_matched']}
+            if not _pipeline_put(write_q, (batch, batch_bytes, last_id, read_stats), stop):
+                break
+    except Exception:
+        error_li.append(sys.exc_info())
+        stop.set()
+    finally:
+        _pipeline_put(write_q, _PIPELINE_DONE, stop)
+        for t in thread_li:
+            t.join()
+    if error_li:
+        reraise(error_li[0])
+    return stats
+
+_merge_worker_context = None    # set by DataBuilder._merge_parallel before forking workers
+_merge_worker_conn = None       # Mongo connection opened by each worker process
+
+
+def _merge_worker(kwargs):
+    '''merge one _id range of a source collection, run in a worker process.'''
+    global _merge_worker_conn
+    t0 = time.time()
+    if _merge_worker_conn is None:
+        _merge_worker_conn = get_src_conn()
+    src = get_src_db(_merge_worker_conn)
+    target = databuild.backend.GeneDocMongoDBBackend(get_target_db(_merge_worker_conn)[kwargs['target_collection']])
+    query = id_range_query(kwargs['start'], kwargs['end'], kwargs['query'])
+    cur = src[kwargs['src_collection']].find(query, timeout=False)
+    cur.batch_size(kwargs['step'])
+    try:
+        stats = _merge_docs_bulk(cur, target,
+                                 _merge_worker_context['geneid_set'],
+                                 idmapping_d=_merge_worker_context['idmapping_d'],
+                                 max_docs=kwargs['max_docs'],
+                                 max_bytes=kwargs['max_bytes'])
+    finally:
+        cur.close()
+    stats.update({'pid': os.getpid(),
+                  'start': kwargs['start'],
+                  'end': kwargs['end'],
+                  'time': timesofar(t0)})
+    return stats
+
+
+def _copy_worker(kwargs):
+    '''copy one _id range of genedocs between two target collections, run in a worker process.'''
+    global _merge_worker_conn
+    t0 = time.time()
+    if _merge_worker_conn is None:
+        _merge_worker_conn = get_src_conn()
+    target_db = get_target_db(_merge_worker_conn)
+    cur = target_db[kwargs['src_collection']].find(id_range_query(kwargs['start'], kwargs['end'], kwargs['query']),
+                                                   timeout=False)
+    cur.batch_size(kwargs['step'])
+    target_collection = target_db[kwargs['target_collection']]
+    cnt = 0
+    try:
+        doc_li = []
+        for doc in cur:
+            doc_li.append(doc)
+            if len(doc_li) >= kwargs['step']:
+                target_collection.insert(doc_li, manipulate=False, check_keys=False)
+                cnt += len(doc_li)
+                doc_li = []
+        if doc_li:
+            target_collection.insert(doc_li, manipulate=False, check_keys=False)
+            cnt += len(doc_li)
+    finally:
+        cur.close()
+    return {'pid': os.getpid(),
+            'start': kwargs['start'],
+            'end': kwargs['end'],
+            'docs_written': cnt,
+            'time': timesofar(t0)}
+
+
+class _ExternalSorter(object):
+    '''sort (key, doc) records by key, stable for records with the same key.
+       records are buffered and sorted in memory in runs of "run_size",
+       full runs are spilled into temp files under "tmp_folder". Call finish()
+       after the last record is added to spill the last run as well, so that
+       no records are held in memory until the sorter is iterated.
+    '''
+    def __init__(self, tmp_folder, run_size=200000):
+        self.tmp_folder = tmp_folder
+        self.run_size = run_size
+        self.cnt = 0
+        self._buffer = []
+        self._run_files = []
+
+    def add(self, key, doc):
+        self._buffer.append((key, self.cnt, doc))
+        self.cnt += 1
+        if len(self._buffer) >= self.run_size:
+            self._spill()
+
+    def finish(self):
+        if self._buffer:
+            self._spill()
+
+    def _spill(self):
+        self._buffer.sort(key=itemgetter(0, 1))
+        fd, run_file = tempfile.mkstemp(suffix='.run', dir=self.tmp_folder)
+        with os.fdopen(fd, 'wb') as out_f:
+            for rec in self._buffer:
+                pickle.dump(rec, out_f, protocol=2)
+        self._run_files.append(run_file)
+        self._buffer = []
+
+    def _read_run(self, run_file):
+        with open(run_file, 'rb') as in_f:
+            while True:
+                try:
+                    yield pickle.load(in_f)
+                except EOFError:
+                    break
+
+    def __iter__(self):
+        '''return (key, seq, doc) records in sorted order.'''
+        self._buffer.sort(key=itemgetter(0, 1))
+        if not self._run_files:
+            return iter(self._buffer)
+        run_li = [self._read_run(run_file) for run_file in self._run_files]
+        return heapq.merge(*(run_li + [iter(self._buffer)]))
+
+
+def _sort_src_docs(sorter, doc_iter, geneid_set, idmapping_d=None, stats=None):
+    '''map docs from a source doc_iter to target _ids in geneid_set (as
+       _iter_bulk_batches does), add them to sorter, and finish it.
+       "docs_read" and "read_time" in optional "stats" are updated.
+    '''
+    stats = stats if stats is not None else {'docs_read': 0, 'read_time': 0}
+    for doc in _timed_iter(doc_iter, stats):
+        stats['docs_read'] += 1
+        _id = doc['_id']
+        if idmapping_d:
+            _id = idmapping_d.get(_id, None) or _id
+        doc.pop('_id', None)
+        doc.pop('taxid', None)
+        for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+            __id = str(__id)
+            if __id in geneid_set:
+                sorter.add(__id, doc)
+    sorter.finish()
+
+
+def _tag_sorted_records(sorter, idx):
+    for key, seq, doc in sorter:
+        yield key, idx, seq, doc
+
+
+def _sortmerge_docs(sorter_li):
+    '''k-way merge all _ExternalSorter in sorter_li, the first of which holds
+       the root docs. yield one assembled genedoc per root doc.
+    '''
+    stream_li = [_tag_sorted_records(sorter, idx) for (idx, sorter) in enumerate(sorter_li)]
+    current_key = None
+    current_doc = None
+    for key, idx, seq, doc in heapq.merge(*stream_li):
+        if key != current_key:
+            if current_doc is not None:
+                yield current_doc
+            current_key = key
+            current_doc = None
+        if idx == 0:
+            current_doc = doc
+        elif current_doc is not None:
+            current_doc.update(doc)
+    if current_doc is not None:
+        yield current_doc
+
+
+def test_sortmerge(run_size=2):
+    '''compare genedocs assembled by _sortmerge_docs (with a tiny run_size, so
+       that every source is spilled into several runs) with those merged
+       sequentially by _merge_docs_bulk, on a small fixture of root docs and
+       three sources, with overlapping fields and an idmapping to multiple ids.
+    '''
+    root_li = [{'_id': str(i), 'taxid': 9606, 'name': 'g{}'.format(i)} for i in range(1, 8)]
+    src_li = [([{'_id': i, 'taxid': 9606, 'go': 'go{}'.format(i), 'x': 1} for i in range(0, 9, 2)], None),
+              ([{'_id': 'ENSG{}'.format(i), 'ensembl': i, 'x': 2} for i in range(1, 5)],
+               {'ENSG1': [1, 3], 'ENSG2': 5, 'ENSG4': 9}),
+              ([{'_id': str(i), 'x': 3, 'name': 'n{}'.format(i)} for i in (1, 6, 7)], None)]
+    geneid_set = set([doc['_id'] for doc in root_li])
+
+    target = databuild.backend.GeneDocMemeoryBackend()
+    target.insert(copy.deepcopy(root_li))
+    for doc_li, idmapping_d in src_li:
+        _merge_docs_bulk(iter(copy.deepcopy(doc_li)), target, geneid_set, idmapping_d=idmapping_d, max_docs=2)
+    expected = [target.get_from_id(_id) for _id in sorted(geneid_set)]
+
+    tmp_folder = tempfile.mkdtemp(prefix='databuild_sortmerge_')
+    try:
+        sorter_li = [_ExternalSorter(tmp_folder, run_size=run_size)]
+        for doc in copy.deepcopy(root_li):
+            sorter_li[0].add(doc['_id'], doc)
+        sorter_li[0].finish()
+        for doc_li, idmapping_d in src_li:
+            sorter = _ExternalSorter(tmp_folder, run_size=run_size)
+            _sort_src_docs(sorter, iter(copy.deepcopy(doc_li)), geneid_set, idmapping_d)
+            assert not sorter._buffer
+            sorter_li.append(sorter)
+        result = list(_sortmerge_docs(sorter_li))
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    assert result == expected, (result, expected)
+    print('OK. {} genedocs are identical.'.format(len(result)))
+
+
 def main():
-    if len(sys.argv) > 1:
-        config = sys.argv[1]
-    else:
-        config = 'mygene_allspecies'
-    use_parallel = '-p' in sys.argv
+    parser = OptionParser(usage="python -m databuild.builder [options] [build_config]")
+    parser.add_option("-p", "--ipython", dest="use_parallel",
+                      action="store_true", default=False,
+                      help="merge on IPython cluster")
+    parser.add_option("-w", "--workers", dest="workers",
+                      action="store", type="int", default=1,
+                      help="number of local worker processes used to merge each source")
+    parser.add_option("", "--sortmerge", dest="use_sortmerge",
+                      action="store_true", default=False,
+                      help="build target in one pass using a sort-merge join")
+    parser.add_option("", "--pipeline", dest="use_pipeline",
+                      action="store_true", default=False,
+                      help="overlap source reads and target writes in separate threads")
+    parser.add_option("", "--derive-from", dest="derive_from",
+                      action="store", default=None,
+                      help="derive target from the last build of given build config, e.g. mygene_allspecies, "
+                           "or merge all sources if it cannot be derived")
+    parser.add_option("", "--print-stats", dest="print_stats",
+                      action="store", type="int", default=0,
+                      help="print per-stage stats of the last N builds and exit")
+    parser.add_option("-i", "--incremental", dest="incremental",
+                      action="store_true", default=False,
+                      help="only re-merge sources changed since last successful build")
+    (options, args) = parser.parse_args()
+    config = args[0] if args else 'mygene_allspecies'
 
     t0 = time.time()
     bdr = DataBuilder(backend='mongodb')
     bdr.load_build_config(config)
-    bdr.using_ipython_cluster = use_parallel
-    bdr.merge()
+    if options.print_stats:
+        bdr.print_build_stats(n=options.print_stats)
+        return
+    bdr.using_ipython_cluster = options.use_parallel
+    bdr.use_sortmerge = options.use_sortmerge
+    bdr.merge_workers = options.workers
+    bdr.use_pipeline = options.use_pipeline
+    derive_error = options.derive_from and bdr.check_derivable(options.derive_from)
+    if derive_error:
+        print('Cannot derive from "{}": {} Merging all sources instead.'.format(options.derive_from, derive_error))
+    if options.derive_from and not derive_error:
+        bdr.derive(options.derive_from, use_parallel=options.workers > 1)
+    else:
+        bdr.merge(incremental=options.incremental)
     print("Finished.", timesofar(t0))
 
 
@@ -50,6 +50,32 @@ def build_index(config, use_parallel=True, noconfirm=False):
         print "Error: target collection is not ready yet or failed to build."
 
 
+def render_bulk(config, folder):
+    '''render the target collection of a build config into bulk files.'''
+    bdr = DataBuilder(backend='mongodb')
+    bdr.load_build_config(config)
+    target_collection = bdr.pick_target_collection()
+    if target_collection:
+        es_idxer = ESIndexer()
+        es_idxer.step = 10000
+        es_idxer.render_bulk_files(target_collection, folder)
+    else:
+        print "Error: target collection is not ready yet or failed to build."
+
+
+def replay_bulk(folder, es_host, es_index, noconfirm=False, max_workers=4):
+    '''send bulk files rendered by render_bulk into es_index on es_host,
+       es_index should be created with the mapping already.
+    '''
+    es_idxer = ESIndexer(es_index_name=es_index, es_host=es_host)
+    print "ES target: {}/{}/{}".format(es_host, es_idxer.ES_INDEX_NAME, es_idxer.ES_INDEX_TYPE)
+    if noconfirm or ask("Continue?") == 'Y':
+        es_idxer.replay_bulk_files(folder, max_workers=max_workers)
+        es_idxer.conn.indices.refresh(es_index)
+    else:
+        print "Aborted."
+
+
 def _pick_one(src_li, prompt="Pick one above: "):
     last_name = ''
     i = 0
@@ -198,6 +224,12 @@ def main():
     noconfirm = '-b' in sys.argv
     if config == 'clean':
         clean_target_collection()
+    elif config == 'render':
+        # python -m databuild.indexer render <config> <folder>
+        render_bulk(sys.argv[2], sys.argv[3])
+    elif config == 'replay':
+        # python -m databuild.indexer replay <folder> <es_host> <es_index>
+        replay_bulk(sys.argv[2], sys.argv[3], sys.argv[4], noconfirm=noconfirm)
     else:
         t0 = time.time()
         build_index(config, use_parallel=use_parallel, noconfirm=noconfirm)
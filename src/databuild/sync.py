@@ -6,11 +6,14 @@ import re
 from datetime import datetime
 import time
 
+from pymongo.errors import PyMongoError
 from utils.mongo import get_target_db, doc_feeder
 from .backend import GeneDocMongoDBBackend
 from utils.diff import diff_collections
-from utils.common import (iter_n, timesofar, LogPrint,
-                          dump, send_s3_file, ask, safewfile,
+from utils.changes import (ChangesWriter, ChangesReader, iter_change_chunks,
+                           get_change_count, is_changes_folder)
+from utils.common import (diff_has_dotted_key, iter_n, timesofar, LogPrint,
+                          send_s3_file, ask, safewfile,
                           is_str)
 from config import LOG_FOLDER
 
@@ -21,6 +24,7 @@ class GeneDocSyncer:
         self._db = get_target_db()
         self._target_col = self._db[self.build_config+'_current']
         self.step = 10000
+        self.bulk_size = 1000    # no. of docs in each bulk write in apply_changes.
 
     def get_source_list(self):
         '''return a list of available source collections.'''
@@ -45,58 +49,138 @@ class GeneDocSyncer:
                 _li.append(src_coll_name)
         return _li
 
-    def get_changes(self, source_col, use_parallel=True):
+    def get_changes(self, source_col, use_parallel=True, streaming=False, runner='local', deep=False,
+                    changes_folder=None):
+        '''return changes between target collection and source_col. if
+           changes_folder is given, changes are written into it as chunk files
+           (see utils.changes) while being computed, and a ChangesReader for
+           it is returned. if changes_folder was written already (by a previous
+           run), it is returned as is, so that apply_changes can resume.
+        '''
         target_col = self._target_col
         source_col = self._db[source_col] if is_str(source_col) else source_col
 
         src = GeneDocMongoDBBackend(source_col)
         target = GeneDocMongoDBBackend(target_col)
-        changes = diff_collections(target, src, use_parallel=use_parallel, step=self.step)
+        if changes_folder and is_changes_folder(changes_folder):
+            print('Found changes in "{}", resuming from it.'.format(changes_folder))
+            return ChangesReader(changes_folder)
+        if changes_folder:
+            with ChangesWriter(changes_folder, source=source_col.name,
+                               timestamp=_get_timestamp(source_col.name)) as writer:
+                counts = diff_collections(target, src, use_parallel=use_parallel, step=self.step,
+                                          streaming=streaming, runner=runner, deep=deep, writer=writer)
+                if counts is None:
+                    writer.abort()
+                    return None
+            return ChangesReader(changes_folder)
+
+        changes = diff_collections(target, src, use_parallel=use_parallel, step=self.step,
+                                   streaming=streaming, runner=runner, deep=deep)
         if changes:
             changes['source'] = source_col.name
             changes['timestamp'] = _get_timestamp(source_col.name)
         return changes
 
     def apply_changes(self, changes):
-        step = self.step
+        '''apply changes to target collection with unordered, acknowledged bulk
+           writes of self.bulk_size docs each. return a report of failed _ids
+           for "add", "delete" and "update", which can be passed to
+           verify_changes, so that only the failed _ids are verified.
+           changes can also be a utils.changes.ChangesReader, then changes are
+           loaded one chunk at a time, and chunks applied already (to the same
+           target collection) are skipped, so an interrupted run can be resumed.
+        '''
+        bulk_size = self.bulk_size
         target_col = self._target_col
         source_col = self._db[changes['source']]
         src = GeneDocMongoDBBackend(source_col)
         target = GeneDocMongoDBBackend(target_col)
         _timestamp = changes['timestamp']
+        report = {'add': [], 'delete': [], 'update': []}
+        progress_key = target_col.name
+
+        def _iter_chunks(op):
+            '''yield change_li of each chunk, and mark a chunk done only if none
+               of its changes failed, so that a resumed run applies it again.
+            '''
+            for chunk_name, change_li in iter_change_chunks(changes, op, chunk_size=self.step,
+                                                            progress_key=progress_key):
+                n_failed = len(report[op])
+                yield change_li
+                if chunk_name:
+                    if len(report[op]) == n_failed:
+                        changes.mark_done(progress_key, chunk_name)
+                    else:
+                        print('\t"{}" not marked done: {} ops failed.'.format(chunk_name, len(report[op]) - n_failed))
+
+        def _apply_bulk(op, fn, id_li):
+            try:
+                failed_li = fn()
+            except PyMongoError as e:
+                print('\tbulk {} failed: {}'.format(op, e))
+                failed_li = list(id_li)
+            if failed_li:
+                print('\t{} {} ops failed'.format(len(failed_li), op))
+                report[op].extend(failed_li)
 
         t0 = time.time()
-        if changes['add']:
-            print("Adding {} new docs...".format(len(changes['add'])), end='')
+        if get_change_count(changes, 'add'):
+            print("Adding {} new docs...".format(get_change_count(changes, 'add')), end='')
             t00 = time.time()
-            for _ids in iter_n(changes['add'], step):
-                _doc_li = src.mget_from_ids(_ids)
-                for _doc in _doc_li:
-                    _doc['_timestamp'] = _timestamp
-                target.insert(_doc_li)
+            for _id_li in _iter_chunks('add'):
+                for _doc_li in iter_n(src.mget_from_ids(_id_li, asiter=True, step=self.step), bulk_size):
+                    for _doc in _doc_li:
+                        _doc['_timestamp'] = _timestamp
+                    _apply_bulk('add', lambda: target.insert_bulk(_doc_li), [_doc['_id'] for _doc in _doc_li])
             print("done. [{}]".format(timesofar(t00)))
-        if changes['delete']:
-            print("Deleting {} discontinued docs...".format(len(changes['delete'])), end='')
+        if get_change_count(changes, 'delete'):
+            print("Deleting {} discontinued docs...".format(get_change_count(changes, 'delete')), end='')
             t00 = time.time()
-            target.remove_from_ids(changes['delete'], step=step)
+            for _id_li in _iter_chunks('delete'):
+                for _ids in iter_n(_id_li, bulk_size):
+                    _ids = list(_ids)
+                    _apply_bulk('delete', lambda: target.remove_bulk(_ids), _ids)
             print("done. [{}]".format(timesofar(t00)))
 
-        if changes['update']:
-            print("Updating {} existing docs...".format(len(changes['update'])))
+        if get_change_count(changes, 'update'):
+            print("Updating {} existing docs...".format(get_change_count(changes, 'update')))
             t00 = time.time()
             i = 0
             t1 = time.time()
-            for _diff in changes['update']:
-                target.update_diff(_diff, extra={'_timestamp': _timestamp})
-                i += 1
-                if i > 1 and i % step == 0:
-                    print('\t{}\t{}'.format(i, timesofar(t1)))
-                    t1 = time.time()
+            for _chunk_li in _iter_chunks('update'):
+                for _diff_li in iter_n(_chunk_li, bulk_size):
+                    _diff_li = list(_diff_li)
+                    # docs with dotted keys cannot be updated by paths, replace them instead.
+                    _ids = [_diff['_id'] for _diff in _diff_li if diff_has_dotted_key(_diff)]
+                    _diff_li = [_diff for _diff in _diff_li if not diff_has_dotted_key(_diff)]
+                    if _diff_li:
+                        _apply_bulk('update', lambda: target.update_diff_bulk(_diff_li, extra={'_timestamp': _timestamp}),
+                                    [_diff['_id'] for _diff in _diff_li])
+                    if _ids:
+                        _doc_li = list(src.mget_from_ids(_ids))
+                        for _doc in _doc_li:
+                            _doc['_timestamp'] = _timestamp
+                        _missing_li = sorted(set(_ids) - set([_doc['_id'] for _doc in _doc_li]))
+                        _apply_bulk('update', lambda: _missing_li + (target.replace_bulk(_doc_li) if _doc_li else []),
+                                    _ids)
+                    i += len(_diff_li)
+                    if i % self.step < bulk_size:
+                        print('\t{}\t{}'.format(i, timesofar(t1)))
+                        t1 = time.time()
             print("done. [{}]".format(timesofar(t00)))
         print("\n")
         print("Finished.", timesofar(t0))
-
-    def verify_changes(self, changes):
+        print("Failed: {}".format(', '.join(['{} {}'.format(len(report[op]), op) for op in report])))
+        return report
+
+    def verify_changes(self, changes, report=None):
+        '''verify changes are applied to target collection. If "report"
+           returned from apply_changes is passed, only the failed _ids in it
+           are verified.
+        '''
+        if report is not None:
+            return self._verify_failed_changes(changes, report)
         _timestamp = changes['timestamp']
         target = GeneDocMongoDBBackend(self._target_col)
         if changes['add']:
@@ -133,6 +217,33 @@ class GeneDocSyncer:
         else:
             print('ERROR!!!\n\t Should be "{}", but get "{}"'.format(len(_li1), len(_li2)))
 
+    def _verify_failed_changes(self, changes, report):
+        _timestamp = changes['timestamp']
+        target = GeneDocMongoDBBackend(self._target_col)
+        if report['add']:
+            print('Verifying {} failed "add"...'.format(len(report['add'])), end='')
+            _cnt = self._target_col.find({'_id': {'$in': report['add']}, '_timestamp': _timestamp}).count()
+            if _cnt == len(report['add']):
+                print('...{}=={}...OK'.format(_cnt, len(report['add'])))
+            else:
+                print('...{}!={}...ERROR!!!'.format(_cnt, len(report['add'])))
+        if report['delete']:
+            print('Verifying {} failed "delete"...'.format(len(report['delete'])), end='')
+            _cnt = target.count_from_ids(report['delete'])
+            if _cnt == 0:
+                print('...{}==0...OK'.format(_cnt))
+            else:
+                print('...{}!=0...ERROR!!!'.format(_cnt))
+        if report['update']:
+            print('Verifying {} failed "update"...'.format(len(report['update'])), end='')
+            _cnt = self._target_col.find({'_id': {'$in': report['update']}, '_timestamp': {'$gte': _timestamp}}).count()
+            if _cnt == len(report['update']):
+                print('...{}=={}...OK'.format(_cnt, len(report['update'])))
+            else:
+                print('...{}!={}...ERROR!!!'.format(_cnt, len(report['update'])))
+        if not any(report.values()):
+            print("No failed changes to verify...OK")
+
     def _get_cleaned_timestamp(self, timestamp):
         if is_str(timestamp):
             timestamp = datetime.strptime(timestamp, '%Y%m%d')
@@ -218,12 +329,13 @@ def _get_timestamp(source_col, as_str=False):
 def get_changes_stats(changes):
     for k in ['source', 'timestamp', 'add', 'delete', 'update']:
         if k in changes:
-            v = changes[k]
-            if isinstance(v, (list, dict)):
-                v = len(v)
+            if k in ['add', 'delete', 'update']:
+                v = get_change_count(changes, k)
+            else:
+                v = changes[k]
             print("{}: {}".format(k, v))
-    _update = changes['update']
-    if _update:
+    if get_change_count(changes, 'update'):
+        _update = changes.iter_op('update') if isinstance(changes, ChangesReader) else changes['update']
         attrs = dict(add=set(), delete=set(), update=set())
         for _d in _update:
             for k in attrs.keys():
@@ -265,6 +377,9 @@ def main():
         config = 'genedoc_' + config
     assert config in ['genedoc_mygene', 'genedoc_mygene_allspecies']
     use_parallel = '-p' in sys.argv
+    streaming = '-s' in sys.argv
+    runner = 'ipython' if '--ipython' in sys.argv else 'local'
+    deep = '--deep' in sys.argv
     no_confirm = '-b' in sys.argv
 
     t0 = time.time()
@@ -286,25 +401,25 @@ def main():
             t0 = time.time()
             print("Current source collection:", src)
             ts = _get_timestamp(src, as_str=True)
-            print("Calculating changes... ")
-            changes = sc.get_changes(src, use_parallel=use_parallel)
+            if config == 'genedoc_mygene':
+                changes_folder = 'changes_{}'.format(ts)
+            else:
+                changes_folder = 'changes_{}_allspecies'.format(ts)
+            print("Calculating changes into \"{}\"... ".format(changes_folder))
+            changes = sc.get_changes(src, use_parallel=use_parallel, streaming=streaming, runner=runner, deep=deep,
+                                     changes_folder=changes_folder)
             print("Done")
             get_changes_stats(changes)
             if no_confirm or ask("Continue to save changes...") == 'Y':
-                if config == 'genedoc_mygene':
-                    dumpfile = 'changes_{}.pyobj'.format(ts)
-                else:
-                    dumpfile = 'changes_{}_allspecies.pyobj'.format(ts)
-                dump(changes, dumpfile)
-                dumpfile_key = 'genedoc_changes/' + dumpfile
-                print('Saving to S3: "{}"... '.format(dumpfile_key), end='')
-                send_s3_file(dumpfile, dumpfile_key)
-                print('Done.')
-                #os.remove(dumpfile)
+                for fn in sorted(os.listdir(changes_folder)):
+                    dumpfile_key = 'genedoc_changes/{}/{}'.format(changes_folder, fn)
+                    print('Saving to S3: "{}"... '.format(dumpfile_key), end='')
+                    send_s3_file(os.path.join(changes_folder, fn), dumpfile_key)
+                    print('Done.')
 
             if no_confirm or ask("Continue to apply changes...") == 'Y':
-                sc.apply_changes(changes)
-                sc.verify_changes(changes)
+                report = sc.apply_changes(changes)
+                sc.verify_changes(changes, report=report)
             print('='*20)
             print("Finished.", timesofar(t0))
 
@@ -4,19 +4,25 @@ from datetime import datetime
 import time
 import re
 import os
+import json
 from pprint import pprint
 
+from concurrent.futures import wait as futures_wait
 from config import TARGET_ES_INDEX_SUFFIX
-from utils.es import ESIndexer
+from utils.es import ESIndexer, BulkSender, iter_bulk_bodies, lastexception
 from utils.mongo import get_target_db, get_src_build
-from utils.common import iter_n, timesofar, ask, loadobj
+from utils.common import iter_n, timesofar, ask, loadobj, DateTimeJSONEncoder, diff_has_dotted_key
 from databuild.backend import GeneDocMongoDBBackend, GeneDocESBackend
 from databuild.sync import get_changes_stats
+from utils.changes import ChangesReader, is_changes_folder, iter_change_chunks, get_change_count
 from .tunnel import open_tunnel, es_local_tunnel_port
 
 
 class ESIndexer2(ESIndexer):
     step = 5000
+    max_partial_update_size = 100000   # diffs larger than this (bytes of json) are re-indexed as full docs.
+    bulk_workers = 4                   # no. of threads sending bulk requests in apply_changes.
+    bulk_max_inflight_bytes = 50 * 1024 * 1024
 
     def _split_source_name(self, source):
         pat = '(\w+)_(\d{8})_\w{8}'
@@ -57,7 +63,32 @@ class ESIndexer2(ESIndexer):
         print('\033[34;06m{}\033[0m:'.format('[Target ES]'))
         self.check()
 
-    def apply_changes(self, changes, verify=True, noconfirm=False):
+    def _split_diffs(self, diff_li):
+        '''split diffs into a list of diffs to apply as partial updates, and a
+           list of _ids to re-index as full docs, for diffs larger than
+           self.max_partial_update_size, or setting values with dotted keys.
+        '''
+        partial_li = []
+        full_ids = []
+        for diff in diff_li:
+            if len(json.dumps(diff, cls=DateTimeJSONEncoder)) > self.max_partial_update_size or \
+               diff_has_dotted_key(diff):
+                full_ids.append(diff['_id'])
+            else:
+                partial_li.append(diff)
+        return partial_li, full_ids
+
+    def apply_changes(self, changes, verify=True, noconfirm=False, partial=True):
+        '''apply changes to this index. changes can be a changes dictionary,
+           or a utils.changes.ChangesReader, which is applied one chunk at a
+           time, and chunks applied already to this index are skipped.
+           if partial is True, "update" changes are applied as partial updates
+           from their diffs (see ESIndexer.update_docs_from_diffs), only large
+           diffs and failed partial updates are re-indexed as full docs.
+           "add", "delete" and "update" bulk requests are sent concurrently by
+           a utils.es.BulkSender with self.bulk_workers threads and at most
+           self.bulk_max_inflight_bytes of requests in flight.
+        '''
         if verify:
             self.pre_verify_changes(changes)
 
@@ -70,35 +101,88 @@ class ESIndexer2(ESIndexer):
         src = GeneDocMongoDBBackend(source_col)
         target = GeneDocESBackend(self)
         _timestamp = changes['timestamp']
+        progress_key = self.ES_INDEX_NAME
+        serializer = self.conn.transport.serializer
+        sender = BulkSender(self.conn, max_workers=self.bulk_workers,
+                            max_inflight_bytes=self.bulk_max_inflight_bytes)
+        pending_li = []     # [(chunk_name, op, _ids, futures)] of chunks being sent
+        failed_li = []      # [(chunk_name, no. of failed changes)]
+
+        def _finish_chunk(chunk_name, op, id_set, future_li):
+            # a chunk is marked as applied only if all its changes succeeded,
+            # failed partial updates are re-indexed as full docs first.
+            n_failed = sum([f.result() for f in future_li])
+            if n_failed and op == 'update':
+                _id_li = [_id for op_type, _id, error in sender.failed if op_type == 'update' and _id in id_set]
+                if _id_li:
+                    print("\t{} partial updates failed, re-indexing as full docs...".format(len(_id_li)))
+                    try:
+                        self.index_bulk(_index_actions(_id_li), step=step)
+                        n_failed -= len(_id_li)
+                    except Exception:
+                        print("\tre-indexing failed: " + lastexception())
+            if n_failed:
+                failed_li.append((chunk_name, n_failed))
+            elif chunk_name:
+                changes.mark_done(progress_key, chunk_name)
+
+        def _finish_chunks(wait=False):
+            while pending_li and (wait or all([f.done() for f in pending_li[0][3]])):
+                chunk_name, op, id_set, future_li = pending_li.pop(0)
+                futures_wait(future_li)
+                _finish_chunk(chunk_name, op, id_set, future_li)
+
+        def _submit_chunks(op, get_actions):
+            for chunk_name, change_li in iter_change_chunks(changes, op, chunk_size=step,
+                                                            progress_key=progress_key):
+                future_li = [sender.submit(body)
+                             for body, n in iter_bulk_bodies(get_actions(change_li), serializer, max_docs=step)]
+                id_set = set([x['_id'] for x in change_li]) if op == 'update' else None
+                pending_li.append((chunk_name, op, id_set, future_li))
+                _finish_chunks()
+
+        def _index_actions(ids):
+            for _doc in src.mget_from_ids(ids, asiter=True, step=step):
+                _doc['_timestamp'] = _timestamp
+                _doc.update({'_index': self.ES_INDEX_NAME,
+                             '_type': self.ES_INDEX_TYPE})
+                yield _doc
 
-        def _add_docs(ids):
-            i = 0
-            for _ids in iter_n(ids, step):
-                t1 = time.time()
-                _doc_li = src.mget_from_ids(_ids)
-                for _doc in _doc_li:
-                    _doc['_timestamp'] = _timestamp
-                    i += 1
-                target.insert(_doc_li)
-                print('\t{}\t{}'.format(i, timesofar(t1)))
+        def _delete_actions(ids):
+            for _id in ids:
+                yield {'_op_type': 'delete',
+                       '_index': self.ES_INDEX_NAME,
+                       '_type': self.ES_INDEX_TYPE,
+                       '_id': _id}
+
+        def _update_actions(diff_li):
+            if not partial:
+                for action in _index_actions([x['_id'] for x in diff_li]):
+                    yield action
+                return
+            _partial_li, _full_ids = self._split_diffs(diff_li)
+            for diff in _partial_li:
+                yield self.get_diff_update_action(diff, extra={'_timestamp': _timestamp})
+            for action in _index_actions(_full_ids):
+                yield action
 
         t0 = time.time()
-        if changes['add']:
-            print("Adding {} new docs...".format(len(changes['add'])))
-            t00 = time.time()
-            _add_docs(changes['add'])
-            print("done. [{}]".format(timesofar(t00)))
-        if changes['delete']:
-            print("Deleting {} discontinued docs...".format(len(changes['delete'])), end='')
-            t00 = time.time()
-            target.remove_from_ids(changes['delete'], step=step)
-            print("done. [{}]".format(timesofar(t00)))
-        if changes['update']:
-            print("Updating {} existing docs...".format(len(changes['update'])))
-            t00 = time.time()
-            ids = [x['_id'] for x in changes['update']]
-            _add_docs(ids)
-            print("done. [{}]".format(timesofar(t00)))
+        for op, get_actions in [('add', _index_actions),
+                                ('delete', _delete_actions),
+                                ('update', _update_actions)]:
+            if get_change_count(changes, op):
+                print("Sending {} \"{}\" changes...".format(get_change_count(changes, op), op))
+                _submit_chunks(op, get_actions)
+        sender.close()
+        _finish_chunks(wait=True)
+
+        if failed_li:
+            print("{} changes failed, in chunks (not marked as applied, so they are applied again "
+                  "in the next run):".format(sum([n for chunk_name, n in failed_li])))
+            for chunk_name, n in failed_li:
+                print('\t{}\t{}'.format(chunk_name, n))
+            for op_type, _id, error in sender.failed:
+                print('\t{}\t{}\t{}'.format(op_type, _id, error))
 
         target.finalize()
 
@@ -128,16 +212,16 @@ class ESIndexer2(ESIndexer):
         _timestamp = changes['timestamp']
         ts_stats = self.get_timestamp_stats()
 
-        if changes['add'] or changes['update']:
+        if get_change_count(changes, 'add') or get_change_count(changes, 'update'):
             print('Verifying "add" and "update"...', end='')
             assert ts_stats[0][0] == _timestamp, "{} != {}".format(ts_stats[0][0], _timestamp)
             _cnt = ts_stats[0][1]
-            _cnt_add_update = len(changes['add']) + len(changes['update'])
+            _cnt_add_update = get_change_count(changes, 'add') + get_change_count(changes, 'update')
             if _cnt == _cnt_add_update:
                 print('...{}=={}...OK'.format(_cnt, _cnt_add_update))
             else:
                 print('...{}!={}...ERROR!!!'.format(_cnt, _cnt_add_update))
-        if changes['delete']:
+        if get_change_count(changes, 'delete'):
             print('Verifying "delete"...', end='')
             _res = target.mget_from_ids(changes['delete'])
             _cnt = len([x for x in _res if x])
@@ -154,6 +238,24 @@ class ESIndexer2(ESIndexer):
         else:
             print('ERROR!!!\n\t Should be "{}", but get "{}"'.format(_cnt_all, _cnt))
 
+        _ids = changes['add'] + [x['_id'] for x in changes['update']]
+        if _ids:
+            print('Verifying "_hash" of {} changed docs...'.format(len(_ids)), end='')
+            src = GeneDocMongoDBBackend(get_target_db()[changes['source']])
+            _cnt = 0
+            for i in range(0, len(_ids), self.step):
+                _id_li = _ids[i:i + self.step]
+                _hash_d = dict([(doc['_id'], doc.get('_hash', None))
+                                for doc in src.mget_from_ids(_id_li, asiter=True, fields=['_hash'])])
+                for doc in target.mget_from_ids(_id_li, fields=['_hash']):
+                    if doc and _hash_d.get(doc['_id'], None) is not None and \
+                       doc.get('_hash', None) == _hash_d[doc['_id']]:
+                        _cnt += 1
+            if _cnt == len(_ids):
+                print('...{}=={}...OK'.format(_cnt, len(_ids)))
+            else:
+                print('...{}!={}...ERROR!!! (or docs have no "_hash")'.format(_cnt, len(_ids)))
+
         print("Verifying all new docs have updated timestamp...")
         q = {
             'query': {
@@ -162,9 +264,8 @@ class ESIndexer2(ESIndexer):
                 }
             }
         }
-        cur = self.doc_feeder(query=q, fields=[], step=10000)
         _li1 = sorted(changes['add'] + [x['_id'] for x in changes['update']])
-        _li2 = sorted([x['_id'] for x in cur])
+        _li2 = sorted(self.get_id_list_parallel(query=q, verbose=False))
         if _li1 == _li2:
             print("{}=={}...OK".format(len(_li1), len(_li2)))
         else:
@@ -179,10 +280,11 @@ class ESIndexer2(ESIndexer):
 
 
 def _get_current_changes_fn(config):
+    '''return the latest changes file or changes folder (see utils.changes).'''
     if config == 'genedoc_mygene_allspecies':
-        pattern = 'changes_\d{8}_allspecies.pyobj'
+        pattern = 'changes_\d{8}_allspecies(\.pyobj)?$'
     elif config == 'genedoc_mygene':
-        pattern = 'changes_\d{8}.pyobj'
+        pattern = 'changes_\d{8}(\.pyobj)?$'
 
     fli = [f for f in os.listdir('.') if re.match(pattern, f)]
     if fli:
@@ -200,6 +302,7 @@ def main():
         config = 'genedoc_' + config
     assert config in ['genedoc_mygene', 'genedoc_mygene_allspecies']
     noconfirm = '-b' in sys.argv
+    partial = '--full-update' not in sys.argv
 
     _changes_fn = _get_current_changes_fn(config)
     if _changes_fn:
@@ -208,7 +311,10 @@ def main():
         print("No changes file found. Aborted.")
         return -1
     if noconfirm or ask("Continue to load?") == 'Y':
-        changes = loadobj(_changes_fn)
+        if is_changes_folder(_changes_fn):
+            changes = ChangesReader(_changes_fn)
+        else:
+            changes = loadobj(_changes_fn)
     else:
         print("Aborted.")
         return -2
@@ -226,7 +332,7 @@ def main():
             meta = esi.get_mapping_meta(changes)
             print('\033[34;06m{}\033[0m:'.format('[Metadata]'))
             pprint(meta)
-            code = esi.apply_changes(changes, noconfirm=noconfirm)
+            code = esi.apply_changes(changes, noconfirm=noconfirm, partial=partial)
             if code != -1:
                 # aborted when code == -1
                 _meta = {'_meta': meta}
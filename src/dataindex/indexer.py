@@ -7,7 +7,7 @@ from utils.common import ask
 from .tunnel import open_tunnel, es_local_tunnel_port
 
 
-def validate(build_config=None):
+def validate(build_config=None, streaming=False, runner='local', max_workers=None):
     from pprint import pprint
     from utils.diff import diff_collections
     from databuild.backend import GeneDocMongoDBBackend, GeneDocESBackend
@@ -25,7 +25,8 @@ def validate(build_config=None):
     b1 = GeneDocMongoDBBackend(mongo_target[target_name])
     b2 = GeneDocESBackend(ESIndexer(es_index_name=target_name,
                                     es_host='127.0.0.1:' + str(es_local_tunnel_port)))
-    changes = diff_collections(b1, b2, use_parallel=True, step=10000)
+    changes = diff_collections(b1, b2, use_parallel=True, step=10000, streaming=streaming,
+                               runner=runner, max_workers=max_workers)
     return changes
 
 
@@ -103,9 +103,13 @@ class GeneDocDispatcher:
         src_clean_archives(noconfirm=True)
         target_clean_collections(noconfirm=True)
 
-        for config in ('mygene', 'mygene_allspecies'):
+        # "mygene" is derived from "mygene_allspecies" by species, instead of
+        # merging all sources again. The builder falls back to a normal merge
+        # if it cannot be derived (see DataBuilder.check_derivable).
+        for config, extra_args in (('mygene_allspecies', []),
+                                   ('mygene', ['--derive-from', 'mygene_allspecies'])):
             t0 = time.time()
-            p = Popen(['python', '-m', 'databuild.builder', config], cwd=src_path)
+            p = Popen(['python', '-m', 'databuild.builder', config] + extra_args, cwd=src_path)
             returncode = p.wait()
             t = timesofar(t0)
             if returncode == 0:
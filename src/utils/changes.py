@@ -0,0 +1,215 @@
+'''
+Chunked changes files for syncing genedoc targets. Changes returned from
+utils.diff.diff_collections are written into a folder of gzipped NDJSON
+chunks plus a manifest, instead of one big pickled dictionary:
+
+    changes_20150301/
+        manifest.json            source, timestamp, counts and chunk files
+        add_00000.ndjson.gz      one _id per line
+        delete_00000.ndjson.gz   one _id per line
+        update_00000.ndjson.gz   one diff (from utils.diff.diff_doc) per line
+        progress.json            chunks applied to each target, for resuming
+
+    with ChangesWriter('changes_20150301', source=src_name, timestamp=ts) as writer:
+        diff_collections(b1, b2, writer=writer)
+    changes = ChangesReader('changes_20150301')
+    for chunk_name, diff_li in changes.iter_chunks('update', progress_key=target_name):
+        ...
+        changes.mark_done(target_name, chunk_name)
+'''
+from __future__ import print_function
+import os
+import os.path
+import shutil
+import gzip
+import json
+from datetime import datetime
+
+from utils.common import DateTimeJSONEncoder
+
+CHANGE_OPS = ('add', 'delete', 'update')
+MANIFEST_FILE = 'manifest.json'
+PROGRESS_FILE = 'progress.json'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _write_json(obj, filename):
+    '''write obj as json into filename atomically.'''
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as out_f:
+        json.dump(obj, out_f, indent=2, cls=DateTimeJSONEncoder)
+    os.rename(tmpfile, filename)
+
+
+def is_changes_folder(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+class ChangesWriter(object):
+    '''write changes into a folder of chunk files incrementally, each chunk has
+       at most "chunk_size" changes. manifest.json is written on close(). A
+       folder left without a manifest (from an interrupted run) is removed,
+       and so is the folder when writing fails within a "with" block.
+    '''
+    def __init__(self, folder, source=None, timestamp=None, chunk_size=10000):
+        if is_changes_folder(folder):
+            raise ValueError('"{}" already exists.'.format(folder))
+        if os.path.exists(folder):
+            print('Removing incomplete changes folder "{}"...'.format(folder))
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        self.folder = folder
+        self.source = source
+        self.timestamp = timestamp
+        self.chunk_size = chunk_size
+        self.counts = dict([(op, 0) for op in CHANGE_OPS])
+        self.chunks = dict([(op, []) for op in CHANGE_OPS])
+        self._pending = dict([(op, []) for op in CHANGE_OPS])
+        self._aborted = False
+
+    def add(self, op, change):
+        '''add a change: an _id for "add" or "delete", a diff for "update".'''
+        self._pending[op].append(change)
+        self.counts[op] += 1
+        if len(self._pending[op]) >= self.chunk_size:
+            self._flush(op)
+
+    def extend(self, op, change_li):
+        for change in change_li:
+            self.add(op, change)
+
+    def _flush(self, op):
+        if self._pending[op]:
+            chunk_name = '{}_{:05d}.ndjson.gz'.format(op, len(self.chunks[op]))
+            out_f = gzip.GzipFile(os.path.join(self.folder, chunk_name), 'wb')
+            try:
+                for change in self._pending[op]:
+                    out_f.write((json.dumps(change, cls=DateTimeJSONEncoder) + '\n').encode('utf-8'))
+            finally:
+                out_f.close()
+            self.chunks[op].append(chunk_name)
+            self._pending[op] = []
+
+    def close(self):
+        for op in CHANGE_OPS:
+            self._flush(op)
+        timestamp = self.timestamp
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.strftime(TIMESTAMP_FORMAT)
+        manifest = {'source': self.source,
+                    'timestamp': timestamp,
+                    'chunk_size': self.chunk_size,
+                    'counts': self.counts,
+                    'chunks': self.chunks,
+                    'created_at': datetime.now()}
+        _write_json(manifest, os.path.join(self.folder, MANIFEST_FILE))
+
+    def abort(self):
+        '''remove the folder, without writing a manifest.'''
+        self._aborted = True
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.abort()
+        elif not self._aborted:
+            self.close()
+
+
+class ChangesReader(object):
+    '''read changes from a folder written by ChangesWriter lazily, chunk by chunk.
+       For compatibility with a changes dictionary, changes['source'] and
+       changes['timestamp'] return values from the manifest, and
+       changes['add'] etc. return all changes of an operation as a list.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE)) as in_f:
+            self.manifest = json.load(in_f)
+        self.counts = self.manifest['counts']
+
+    @property
+    def source(self):
+        return self.manifest['source']
+
+    @property
+    def timestamp(self):
+        timestamp = self.manifest['timestamp']
+        if timestamp:
+            timestamp = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        return timestamp
+
+    def __getitem__(self, key):
+        if key in CHANGE_OPS:
+            return list(self.iter_op(key))
+        elif key == 'timestamp':
+            return self.timestamp
+        else:
+            return self.manifest[key]
+
+    def __contains__(self, key):
+        return key in CHANGE_OPS or key in self.manifest
+
+    def _read_chunk(self, chunk_name):
+        in_f = gzip.GzipFile(os.path.join(self.folder, chunk_name), 'rb')
+        try:
+            return [json.loads(line.decode('utf-8')) for line in in_f if line.strip()]
+        finally:
+            in_f.close()
+
+    def get_progress(self, progress_key):
+        '''return the set of chunk names already applied for progress_key.'''
+        progress_file = os.path.join(self.folder, PROGRESS_FILE)
+        if os.path.exists(progress_file):
+            with open(progress_file) as in_f:
+                return set(json.load(in_f).get(progress_key, []))
+        return set()
+
+    def mark_done(self, progress_key, chunk_name):
+        '''record chunk_name as applied for progress_key (e.g. a target name).'''
+        progress_file = os.path.join(self.folder, PROGRESS_FILE)
+        progress = {}
+        if os.path.exists(progress_file):
+            with open(progress_file) as in_f:
+                progress = json.load(in_f)
+        progress.setdefault(progress_key, []).append(chunk_name)
+        _write_json(progress, progress_file)
+
+    def iter_chunks(self, op, progress_key=None):
+        '''yield (chunk_name, change_li) for each chunk of an operation. if
+           progress_key is given, chunks marked done for it are skipped.
+        '''
+        done = self.get_progress(progress_key) if progress_key else set()
+        for chunk_name in self.manifest['chunks'][op]:
+            if chunk_name in done:
+                print('\tskipping "{}" (already applied).'.format(chunk_name))
+                continue
+            yield chunk_name, self._read_chunk(chunk_name)
+
+    def iter_op(self, op):
+        for chunk_name, change_li in self.iter_chunks(op):
+            for change in change_li:
+                yield change
+
+
+def iter_change_chunks(changes, op, chunk_size=10000, progress_key=None):
+    '''yield (chunk_name, change_li) from either a changes dictionary (where
+       chunk_name is None) or a ChangesReader.
+    '''
+    if isinstance(changes, ChangesReader):
+        for chunk in changes.iter_chunks(op, progress_key=progress_key):
+            yield chunk
+    else:
+        change_li = changes[op]
+        for i in range(0, len(change_li), chunk_size):
+            yield None, change_li[i:i + chunk_size]
+
+
+def get_change_count(changes, op):
+    if isinstance(changes, ChangesReader):
+        return changes.counts[op]
+    else:
+        return len(changes[op])
@@ -62,6 +62,17 @@ def get_random_string():
     return base64.b64encode(os.urandom(6), random.sample(string.letters, 2))
 
 
+def get_peak_rss_mb():
+    '''return the peak resident set size (in MB) of current process, or of any
+       of its terminated child processes if larger.'''
+    import resource
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        rss = rss / 1024.    # in bytes on Mac OS X, in KB on Linux.
+    return round(rss / 1024., 1)
+
+
 class LogPrint:
     def __init__(self, log_f, log=1, timestamp=0):
         '''If this class is set to sys.stdout, it will output both log_f and __stdout__.
@@ -263,6 +274,44 @@ def is_str(s):
     return isinstance(s, str_types)
 
 
+def reraise(exc_info):
+    '''re-raise an exception from sys.exc_info() with its original traceback,
+       e.g. one caught in another thread.
+    '''
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def get_doc_hash(doc, exclude_attrs=('_timestamp', '_hash')):
+    '''return a stable md5 hex digest of the content of a doc, computed from
+       its canonical JSON serialization (sorted keys), excluding attributes
+       in exclude_attrs.
+    '''
+    import hashlib
+    _doc = dict([(k, v) for k, v in doc.items() if k not in exclude_attrs])
+    s = json.dumps(_doc, sort_keys=True, separators=(',', ':'), cls=DateTimeJSONEncoder)
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+def has_dotted_key(obj):
+    '''return True if any key of the dictionaries in obj (searched recursively,
+       also in lists) contains ".", which is ambiguous in a dotted path.
+    '''
+    if isinstance(obj, dict):
+        return any(['.' in k or has_dotted_key(v) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple)):
+        return any([has_dotted_key(v) for v in obj])
+    return False
+
+
+def diff_has_dotted_key(diff):
+    '''return True if a diff from utils.diff.diff_doc sets values with dotted
+       keys, which cannot be applied as a partial update of paths: Mongo
+       rejects them in "$set", and they would be read as paths in ES. Such
+       docs should be replaced as a whole instead.
+    '''
+    return has_dotted_key(list(diff.get('add', {}).values()) + list(diff.get('update', {}).values()))
+
+
 def is_seq(li):
     """return True if input is either a list or a tuple.
     """
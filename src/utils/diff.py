@@ -4,43 +4,71 @@ Utils to compare two list of gene documents
 from __future__ import print_function
 import time
 import os.path
-from utils.common import timesofar
+from utils.common import timesofar, has_dotted_key
 from databuild.backend import GeneDocMongoDBBackend, GeneDocESBackend
 from utils.mongo import get_target_db
 from utils.es import ESIndexer
 
 
-def diff_doc(doc_1, doc_2, exclude_attrs=['_timestamp']):
+def diff_doc(doc_1, doc_2, exclude_attrs=['_timestamp'], deep=False):
+    '''return the diff of two docs, or None if they are the same.
+       if deep is True, attributes which are dictionaries in both docs are
+       compared recursively, and the diff contains dotted paths instead,
+       e.g. {'update': {'go.BP': [...]}, 'delete': ['exons.NM_000075'], 'add': {}}
+       an attribute with a key containing "." anywhere in it is not compared
+       recursively, but updated as a whole, since its paths would be ambiguous.
+    '''
     diff_d = {'update': {},
               'delete': [],
               'add': {}}
+    _diff_doc(doc_1, doc_2, diff_d, exclude_attrs=exclude_attrs, deep=deep)
+    if diff_d['update'] or diff_d['delete'] or diff_d['add']:
+        return diff_d
+
+
+def _diff_doc(doc_1, doc_2, diff_d, exclude_attrs=None, deep=False, prefix=''):
     for attr in set(doc_1) | set(doc_2):
         if exclude_attrs and attr in exclude_attrs:
             continue
+        path = prefix + attr
         if attr in doc_1 and attr in doc_2:
             _v1 = doc_1[attr]
             _v2 = doc_2[attr]
             if _v1 != _v2:
-                diff_d['update'][attr] = _v2
+                if deep and isinstance(_v1, dict) and isinstance(_v2, dict) and \
+                   not has_dotted_key(_v1) and not has_dotted_key(_v2):
+                    _diff_doc(_v1, _v2, diff_d, deep=deep, prefix=path + '.')
+                else:
+                    diff_d['update'][path] = _v2
         elif attr in doc_1 and attr not in doc_2:
-            diff_d['delete'].append(attr)
+            diff_d['delete'].append(path)
         else:
-            diff_d['add'][attr] = doc_2[attr]
-    if diff_d['update'] or diff_d['delete'] or diff_d['add']:
-        return diff_d
+            diff_d['add'][path] = doc_2[attr]
 
 
-def two_docs_iterator(b1, b2, id_list, step=10000):
+def two_docs_iterator(b1, b2, id_list, step=10000, fields=None):
+    '''iterate pairs of docs with the same _id from backends b1 and b2, for
+       ids in id_list (should exist in both). "fields" is an optional list of
+       fields to fetch, e.g. for comparing only some attributes.
+       docs are paired by _id, ids missing in either backend (e.g. deleted
+       after id_list was made) are skipped.
+    '''
     t0 = time.time()
     n = len(id_list)
     for i in range(0, n, step):
         t1 = time.time()
         print("Processing %d-%d documents..." % (i + 1, min(i + step, n)), end='')
         _ids = id_list[i:i+step]
-        iter1 = b1.mget_from_ids(_ids, asiter=True)
-        iter2 = b2.mget_from_ids(_ids, asiter=True)
-        for doc1, doc2 in zip(iter1, iter2):
-            yield doc1, doc2
+        # a backend may skip missing ids, or return None for them.
+        doc2_d = dict([(doc['_id'], doc) for doc in b2.mget_from_ids(_ids, asiter=True, step=step, fields=fields)
+                       if doc])
+        cnt = 0
+        for doc1 in b1.mget_from_ids(_ids, asiter=True, step=step, fields=fields):
+            if doc1 and doc1['_id'] in doc2_d:
+                cnt += 1
+                yield doc1, doc2_d[doc1['_id']]
+        if cnt < len(_ids):
+            print('%d ids missing...' % (len(_ids) - cnt), end='')
         print('Done.[%.1f%%,%s]' % (i*100./n, timesofar(t1)))
     print("="*20)
     print('Finished.[total time: %s]' % timesofar(t0))
@@ -62,10 +90,74 @@ def _diff_doc_worker(args):
     return _updates
 
 
-def _diff_doc_inner_worker(b1, b2, ids, fastdiff=False):
+def _hash_differs(doc1, doc2):
+    '''return True if the "_hash" (see utils.common.get_doc_hash) of two docs
+       differ, or is missing in any of them.
+    '''
+    _h1 = doc1.get('_hash', None)
+    _h2 = doc2.get('_hash', None)
+    return _h1 is None or _h2 is None or _h1 != _h2
+
+
+_diff_worker_backends = {}    # backends created in each local diff worker process, by their args
+
+
+def _get_backend_args(b):
+    '''return args for get_backend to re-create backend b in another process.'''
+    if b.name == 'es':
+        kwargs = {'es_host': b.target_esidxer.es_host,
+                  'es_index_type': b.target_esidxer.ES_INDEX_TYPE}
+    else:
+        kwargs = {}
+    return (b.target_name, b.name, tuple(sorted(kwargs.items())))
+
+
+def _diff_local_worker(args):
+    '''compare docs of given ids in a local worker process. backends are created
+       once per worker process and reused by following tasks.
+    '''
+    b1_args, b2_args, ids, deep = args
+    for _args in (b1_args, b2_args):
+        if _args not in _diff_worker_backends:
+            target_name, bk_type, kwargs = _args
+            _diff_worker_backends[_args] = get_backend(target_name, bk_type, **dict(kwargs))
+    return _diff_doc_inner_worker(_diff_worker_backends[b1_args], _diff_worker_backends[b2_args], ids, deep=deep)
+
+
+def iter_diff_parallel(b1, b2, ids, step=10000, max_workers=None, deep=False):
+    '''compare docs of given ids (existing in both backends) in a local process
+       pool, partitioned into chunks of "step" ids. the list of diffs of each
+       partition is yielded as soon as it completes, in no particular order.
+       max_workers defaults to the number of CPUs.
+    '''
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+    max_workers = max_workers or multiprocessing.cpu_count()
+    _b1 = _get_backend_args(b1)
+    _b2 = _get_backend_args(b2)
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_li = [executor.submit(_diff_local_worker, (_b1, _b2, ids[i:i + step], deep))
+                     for i in range(0, len(ids), step)]
+        print("\t# of tasks: {} ({} workers)".format(len(future_li), max_workers))
+        for i, future in enumerate(as_completed(future_li)):
+            _updates = future.result()
+            print('\t{}/{} done, {} docs changed [{}]'.format(i + 1, len(future_li), len(_updates), timesofar(t0)))
+            yield _updates
+
+
+def _diff_doc_inner_worker(b1, b2, ids, fastdiff=False, use_hash=True, deep=False):
     '''if fastdiff is True, only compare the whole doc,
        do not traverse into each attributes.
+       if deep is True, nested attributes are diffed as dotted paths (see diff_doc).
+       if use_hash is True, only "_hash" of docs are fetched first, and only
+       docs with different (or missing) hashes are fetched and compared.
     '''
+    if use_hash:
+        ids = [doc1['_id'] for doc1, doc2 in two_docs_iterator(b1, b2, ids, fields=['_hash'])
+               if _hash_differs(doc1, doc2)]
+        if not ids:
+            return []
     _updates = []
     for doc1, doc2 in two_docs_iterator(b1, b2, ids):
         assert doc1['_id'] == doc2['_id'], repr((ids, len(ids)))
@@ -73,20 +165,116 @@ def _diff_doc_inner_worker(b1, b2, ids, fastdiff=False):
             if doc1 != doc2:
                 _updates.append({'_id': doc1['_id']})
         else:
-            _diff = diff_doc(doc1, doc2)
+            _diff = diff_doc(doc1, doc2, deep=deep)
             if _diff:
                 _diff['_id'] = doc1['_id']
                 _updates.append(_diff)
     return _updates
 
 
-def diff_collections(b1, b2, use_parallel=True, step=10000):
+def _check_sorted(doc_iter, name):
+    '''pass through docs from doc_iter, raise ValueError if they are not in _id order.'''
+    last_id = None
+    for doc in doc_iter:
+        if last_id is not None and not doc['_id'] > last_id:
+            raise ValueError('Docs from "{}" are not in _id order: "{}" after "{}".'.format(name, doc['_id'], last_id))
+        last_id = doc['_id']
+        yield doc
+
+
+def iter_diff_collections(b1, b2, step=10000, fastdiff=False, use_hash=True, deep=False):
+    '''compare two backends by scanning both in _id order (see sorted_doc_feeder
+       of backend classes), and walking them like a merge join, so that memory
+       use is constant. Changes are yielded as they are found:
+           ('delete', _id)     _id only in b1
+           ('add', _id)        _id only in b2
+           ('update', diff)    diff from diff_doc with "_id" ({'_id': _id} if fastdiff)
+       if use_hash is True, only "_hash" of docs are scanned, and docs with
+       different (or missing) hashes are fetched in batches of "step" and
+       compared, so "update" changes may be yielded later than the others.
+    '''
+    fields = ['_hash'] if use_hash else None
+    iter1 = _check_sorted(b1.sorted_doc_feeder(step=step, fields=fields), b1.target_name)
+    iter2 = _check_sorted(b2.sorted_doc_feeder(step=step, fields=fields), b2.target_name)
+    id_li = []    # ids with different hashes, to be compared
+    doc1 = next(iter1, None)
+    doc2 = next(iter2, None)
+    while doc1 is not None or doc2 is not None:
+        if doc2 is None or (doc1 is not None and doc1['_id'] < doc2['_id']):
+            yield 'delete', doc1['_id']
+            doc1 = next(iter1, None)
+        elif doc1 is None or doc2['_id'] < doc1['_id']:
+            yield 'add', doc2['_id']
+            doc2 = next(iter2, None)
+        else:
+            if use_hash:
+                if _hash_differs(doc1, doc2):
+                    id_li.append(doc1['_id'])
+                    if len(id_li) >= step:
+                        for _diff in _diff_doc_inner_worker(b1, b2, id_li, fastdiff=fastdiff, use_hash=False, deep=deep):
+                            yield 'update', _diff
+                        id_li = []
+            elif fastdiff:
+                if doc1 != doc2:
+                    yield 'update', {'_id': doc1['_id']}
+            else:
+                _diff = diff_doc(doc1, doc2, deep=deep)
+                if _diff:
+                    _diff['_id'] = doc1['_id']
+                    yield 'update', _diff
+            doc1 = next(iter1, None)
+            doc2 = next(iter2, None)
+    if id_li:
+        for _diff in _diff_doc_inner_worker(b1, b2, id_li, fastdiff=fastdiff, use_hash=False, deep=deep):
+            yield 'update', _diff
+
+
+def _diff_collections_streaming(b1, b2, step=10000, deep=False, writer=None):
+    t0 = time.time()
+    changes = {'update': [],
+               'delete': [],
+               'add': []}
+    counts = {'update': 0,
+              'delete': 0,
+              'add': 0}
+    cnt = 0
+    t1 = time.time()
+    for op, change in iter_diff_collections(b1, b2, step=step, deep=deep):
+        if writer:
+            writer.add(op, change)
+        else:
+            changes[op].append(change)
+        counts[op] += 1
+        cnt += 1
+        if cnt % step == 0:
+            print('\t{} changes found...[{}]'.format(cnt, timesofar(t1)))
+            t1 = time.time()
+    print("# of docs found only in collection 1:\t", counts['delete'])
+    print("# of docs found only in collection 2:\t", counts['add'])
+    print("Done. [{} docs changed, {}]".format(counts['update'], timesofar(t0)))
+    return counts if writer else changes
+
+
+def diff_collections(b1, b2, use_parallel=True, step=10000, streaming=False, runner='local', max_workers=None,
+                     deep=False, writer=None):
     """
     b1, b2 are one of supported backend class in databuild.backend.
     e.g.,
         b1 = GeneDocMongoDBBackend(c1)
         b2 = GeneDocMongoDBBackend(c2)
+    if streaming is True, both backends are scanned in _id order and compared
+    with constant memory, see iter_diff_collections. use_parallel is ignored then.
+    if use_parallel is True, matching docs are compared by "runner", either
+    "local" (a local process pool of max_workers, see iter_diff_parallel), or
+    "ipython" (on IPython cluster).
+    if deep is True, nested attributes of updated docs are diffed as dotted
+    paths (see diff_doc), not supported by "ipython" runner.
+    if writer (a utils.changes.ChangesWriter) is given, changes are written
+    into it as they are found instead of kept in memory, and only the counts
+    of "update", "delete" and "add" changes are returned.
     """
+    if streaming:
+        return _diff_collections_streaming(b1, b2, step=step, deep=deep, writer=writer)
 
     id_s1 = set(b1.get_id_list())
     id_s2 = set(b2.get_id_list())
@@ -102,11 +290,21 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
 
     print("Comparing matching docs...")
     _updates = []
+    n_updates = 0
     if len(id_common) > 0:
         if not use_parallel:
-            _updates = _diff_doc_inner_worker(b1, b2, list(id_common))
+            _updates = _diff_doc_inner_worker(b1, b2, list(id_common), deep=deep)
+        elif runner == 'local':
+            _updates = []
+            for res in iter_diff_parallel(b1, b2, list(id_common), step=step, max_workers=max_workers, deep=deep):
+                if writer:
+                    writer.extend('update', res)
+                    n_updates += len(res)
+                else:
+                    _updates.extend(res)
         else:
             from utils.parallel import run_jobs_on_ipythoncluster
+            assert not deep, '"deep" diff is not supported by "ipython" runner.'
             _path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
             id_common = list(id_common)
             #b1_target_collection = b1.target_collection.name
@@ -124,7 +322,10 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
                 print("Parallel jobs failed or were interrupted.")
                 return None
 
-        print("Done. [{} docs changed]".format(len(_updates)))
+        if writer and _updates:
+            writer.extend('update', _updates)
+        n_updates += len(_updates)
+        print("Done. [{} docs changed]".format(n_updates))
 
     _deletes = []
     if len(id_in_1) > 0:
@@ -134,6 +335,13 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
     if len(id_in_2) > 0:
         _adds = sorted(id_in_2)
 
+    if writer:
+        writer.extend('delete', _deletes)
+        writer.extend('add', _adds)
+        return {'update': n_updates,
+                'delete': len(_deletes),
+                'add': len(_adds)}
+
     changes = {'update': _updates,
                'delete': _deletes,
                'add': _adds}
@@ -1,14 +1,28 @@
 from __future__ import print_function
 import sys
+import os
 import time
 import re
+import json
+import gzip
+import threading
+from datetime import datetime
 
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from elasticsearch.exceptions import TransportError
+from elasticsearch.serializer import JSONSerializer
 
 from config import ES_HOST, ES_INDEX_NAME, ES_INDEX_TYPE
-from utils.common import ask, timesofar
-from utils.mongo import doc_feeder
+from utils.common import ask, timesofar, get_doc_hash, diff_has_dotted_key
+from utils.mongo import doc_feeder, get_src_conn, id_range_partition, id_range_query
+from utils.idmapping import GeneIdSet
 
 # setup ES loggingre
 import logging
@@ -45,9 +59,356 @@ def lastexception():
     return str(exc_type)+':'+''.join([str(x) for x in excArgs])
 
 
+# set values of (dotted) paths in "sets" param, replacing existing values, and
+# remove (dotted) paths in "unsets" param from a doc, used for partial updates.
+# the "_timestamp" meta field is set from "timestamp" param if not null.
+# As an inline groovy script, it requires dynamic scripting to be enabled on
+# the cluster ("script.disable_dynamic: false" on ES 1.x), otherwise every
+# update using it fails, and those docs must be re-indexed as full docs (as
+# DataIndexer.apply_changes in dataindex.es_sync does for failed updates).
+SET_UNSET_PATHS_SCRIPT = '''
+for (entry in sets.entrySet()) {
+    def keys = entry.key.tokenize('.');
+    def obj = ctx._source;
+    for (int i = 0; i < keys.size() - 1; i++) {
+        if (!(obj[keys[i]] instanceof Map)) {
+            obj[keys[i]] = [:];
+        }
+        obj = obj[keys[i]];
+    }
+    obj[keys[-1]] = entry.value;
+}
+for (path in unsets) {
+    def keys = path.tokenize('.');
+    def obj = ctx._source;
+    for (int i = 0; i < keys.size() - 1 && obj instanceof Map; i++) {
+        obj = obj[keys[i]];
+    }
+    if (obj instanceof Map) {
+        obj.remove(keys[-1]);
+    }
+}
+if (timestamp != null) {
+    ctx._timestamp = timestamp;
+}
+'''
+
+def _expand_dotted_paths(d):
+    '''expand dotted paths into nested dictionaries,
+       e.g. {'go.BP': 1, 'a': 2} -> {'go': {'BP': 1}, 'a': 2}
+    '''
+    out = {}
+    for path, value in d.items():
+        keys = path.split('.')
+        _d = out
+        for key in keys[:-1]:
+            _d = _d.setdefault(key, {})
+        _d[keys[-1]] = value
+    return out
+
+
+def iter_bulk_bodies(actions, serializer, max_docs=5000, max_bytes=10 * 1024 * 1024):
+    '''serialize bulk actions (as passed to elasticsearch.helpers.bulk) into
+       bulk request bodies of at most max_docs actions and about max_bytes
+       each. yield (body, n_actions). max_bytes can also be a function
+       returning the current limit, e.g. AdaptiveBulkController.get_bulk_bytes.
+    '''
+    get_max_bytes = max_bytes if callable(max_bytes) else lambda: max_bytes
+    entry_li = []
+    size = 0
+    for action in actions:
+        action, data = helpers.expand_action(action)
+        entry = serializer.dumps(action) + '\n'
+        if data is not None:
+            entry += serializer.dumps(data) + '\n'
+        if entry_li and (len(entry_li) >= max_docs or size + len(entry) > get_max_bytes()):
+            yield ''.join(entry_li), len(entry_li)
+            entry_li = []
+            size = 0
+        entry_li.append(entry)
+        size += len(entry)
+    if entry_li:
+        yield ''.join(entry_li), len(entry_li)
+
+
+def _split_bulk_body(body):
+    '''split a bulk request body into a list of (action, entry) for each action,
+       where entry is the action line(s) of the body.
+    '''
+    lines = [line for line in body.split('\n') if line]
+    entry_li = []
+    i = 0
+    while i < len(lines):
+        action = json.loads(lines[i])
+        n = 1 if 'delete' in action else 2
+        entry_li.append((action, '\n'.join(lines[i:i + n]) + '\n'))
+        i += n
+    return entry_li
+
+
+class BulkSender(object):
+    '''send bulk request bodies (see iter_bulk_bodies) concurrently from a pool
+       of max_workers threads, with at most max_inflight_bytes of bodies being
+       sent or queued, submit() blocks until there is room. Requests rejected
+       by ES (status 429, e.g. bulk queue is full) and rejected items are
+       retried up to max_retries times, with exponential backoff starting from
+       retry_backoff seconds. docs/sec is printed every report_interval seconds.
+       index and doc_type are the defaults for actions without "_index" or
+       "_type", e.g. bodies read from bulk files (see ESIndexer.render_bulk_files).
+
+           with BulkSender(esi.conn, max_workers=4) as sender:
+               for body, n in iter_bulk_bodies(actions, esi.conn.transport.serializer):
+                   sender.submit(body)
+           print(sender.stats, sender.failed)
+    '''
+    def __init__(self, conn, max_workers=4, max_inflight_bytes=50 * 1024 * 1024, max_retries=5,
+                 retry_backoff=2, report_interval=10, verbose=True, index=None, doc_type=None):
+        self.conn = conn
+        self.index = index
+        self.doc_type = doc_type
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.report_interval = report_interval
+        self.verbose = verbose
+        self.stats = {'docs': 0, 'failed': 0, 'bytes': 0, 'requests': 0, 'retries': 0}
+        self.failed = []     # list of (op_type, _id, error)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._inflight_bytes = 0
+        self._t0 = self._t_report = time.time()
+
+    def submit(self, body):
+        '''send a bulk request body in a worker thread, return a Future of the
+           no. of actions failed.
+        '''
+        size = len(body)
+        with self._cond:
+            while self._inflight_bytes and self._inflight_bytes + size > self.max_inflight_bytes:
+                self._cond.wait()
+            self._inflight_bytes += size
+        future = self._pool.submit(self._send, body)
+        future.add_done_callback(lambda f: self._release(size))
+        return future
+
+    def _release(self, size):
+        with self._cond:
+            self._inflight_bytes -= size
+            self._cond.notify_all()
+
+    def _update_stats(self, **kwargs):
+        with self._lock:
+            for k in kwargs:
+                self.stats[k] += kwargs[k]
+            t = time.time()
+            if self.verbose and t - self._t_report >= self.report_interval:
+                self._t_report = t
+                print('\t{} docs sent [{:.0f} docs/sec, {} failed, {} retries]'.format(
+                    self.stats['docs'], self.stats['docs'] / (t - self._t0), self.stats['failed'],
+                    self.stats['retries']))
+
+    def _fail(self, entry_li, error):
+        with self._lock:
+            for action, entry in entry_li:
+                op_type, meta = list(action.items())[0]
+                self.failed.append((op_type, meta.get('_id', None), error))
+        self._update_stats(failed=len(entry_li))
+        return len(entry_li)
+
+    def _send(self, body):
+        '''send a bulk body, return the no. of failed actions.'''
+        n_failed = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                self._update_stats(retries=1)
+            try:
+                res = self.conn.bulk(body=body, index=self.index, doc_type=self.doc_type)
+            except TransportError as e:
+                if e.status_code == 429 and attempt < self.max_retries:
+                    continue
+                return n_failed + self._fail(_split_bulk_body(body), lastexception())
+            except Exception:
+                return n_failed + self._fail(_split_bulk_body(body), lastexception())
+            self._update_stats(requests=1, bytes=len(body))
+            if not res.get('errors', False):
+                self._update_stats(docs=len(res['items']))
+                return n_failed
+            rejected_li = []
+            failed_li = []
+            n_ok = 0
+            for (action, entry), item in zip(_split_bulk_body(body), res['items']):
+                result = list(item.values())[0]
+                if result.get('status', None) == 429:
+                    rejected_li.append((action, entry))
+                elif 'error' in result:
+                    failed_li.append((action, entry, result['error']))
+                else:
+                    n_ok += 1
+            self._update_stats(docs=n_ok)
+            for action, entry, error in failed_li:
+                n_failed += self._fail([(action, entry)], error)
+            if not rejected_li:
+                return n_failed
+            if attempt == self.max_retries:
+                return n_failed + self._fail(rejected_li, 'rejected')
+            body = ''.join([entry for action, entry in rejected_li])
+
+    def close(self):
+        '''wait for all submitted requests to finish, and return stats.'''
+        self._pool.shutdown(wait=True)
+        if self.verbose:
+            t = time.time() - self._t0
+            print('\t{} docs sent in {} [{:.0f} docs/sec, {} failed, {} retries]'.format(
+                self.stats['docs'], timesofar(self._t0), self.stats['docs'] / t if t else 0,
+                self.stats['failed'], self.stats['retries']))
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def iter_bulk_file_bodies(filename, max_bytes=10 * 1024 * 1024):
+    '''read a bulk file written by ESIndexer.render_bulk_files, and yield
+       bulk request bodies of about max_bytes each.
+    '''
+    in_f = gzip.GzipFile(filename, 'rb')
+    try:
+        entry_li = []
+        size = 0
+        for action_line in in_f:
+            entry = (action_line + next(in_f)).decode('utf-8')
+            if entry_li and size + len(entry) > max_bytes:
+                yield ''.join(entry_li)
+                entry_li = []
+                size = 0
+            entry_li.append(entry)
+            size += len(entry)
+        if entry_li:
+            yield ''.join(entry_li)
+    finally:
+        in_f.close()
+
+
+class AdaptiveBulkController(object):
+    '''send bulk requests sized by bytes, adapting the size to the cluster:
+         - latency below low_latency (in seconds): grow bulk_bytes by grow_factor
+         - latency above high_latency: shrink bulk_bytes by shrink_factor
+         - requests or items rejected (status 429): shrink bulk_bytes, wait and
+           retry the rejected items, the wait doubles on consecutive rejections
+       bulk_bytes stays within [min_bytes, max_bytes]. Each decision is
+       printed, so it shows up in the indexing log, and kept in self.decisions.
+
+           controller = AdaptiveBulkController()
+           cnt, failed_li = controller.bulk(esi.conn, actions)
+    '''
+    def __init__(self, bulk_bytes=5 * 1024 * 1024, min_bytes=512 * 1024, max_bytes=50 * 1024 * 1024,
+                 max_docs=10000, low_latency=5, high_latency=30, grow_factor=1.5, shrink_factor=0.5,
+                 backoff=1, max_backoff=60, max_retries=10):
+        self.bulk_bytes = bulk_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.low_latency = low_latency
+        self.high_latency = high_latency
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.decisions = []
+        self._wait = backoff
+
+    def get_bulk_bytes(self):
+        return self.bulk_bytes
+
+    def _resize(self, factor, reason):
+        bulk_bytes = int(min(max(self.bulk_bytes * factor, self.min_bytes), self.max_bytes))
+        if bulk_bytes != self.bulk_bytes:
+            print('\tbulk size: {}KB -> {}KB ({})'.format(self.bulk_bytes // 1024, bulk_bytes // 1024, reason))
+            self.decisions.append((time.time(), self.bulk_bytes, bulk_bytes, reason))
+            self.bulk_bytes = bulk_bytes
+
+    def on_success(self, latency, size):
+        '''adapt bulk_bytes from the latency of a successful request of size bytes.'''
+        self._wait = self.backoff
+        if latency > self.high_latency:
+            self._resize(self.shrink_factor, 'latency {:.1f}s'.format(latency))
+        elif latency < self.low_latency and size >= self.bulk_bytes * self.shrink_factor:
+            # only grow when requests are actually filled up to the current size
+            self._resize(self.grow_factor, 'latency {:.1f}s'.format(latency))
+
+    def on_rejected(self, n_rejected):
+        '''shrink bulk_bytes and wait before retrying n_rejected actions.'''
+        self._resize(self.shrink_factor, '{} rejected'.format(n_rejected))
+        print('\tpausing for {}s after {} rejected...'.format(self._wait, n_rejected))
+        self.decisions.append((time.time(), self.bulk_bytes, self.bulk_bytes, 'pause {}s'.format(self._wait)))
+        time.sleep(self._wait)
+        self._wait = min(self._wait * 2, self.max_backoff)
+
+    def send(self, conn, body):
+        '''send a bulk request body, retrying rejected items. return the no. of
+           succeeded actions and a list of (_id, error) of failed actions.
+        '''
+        n_ok = 0
+        failed_li = []
+        for attempt in range(self.max_retries + 1):
+            t0 = time.time()
+            try:
+                res = conn.bulk(body=body)
+            except TransportError as e:
+                if e.status_code == 429 and attempt < self.max_retries:
+                    self.on_rejected(len(_split_bulk_body(body)))
+                    continue
+                raise
+            latency = time.time() - t0
+            rejected_li = []
+            if res.get('errors', False):
+                for (action, entry), item in zip(_split_bulk_body(body), res['items']):
+                    result = list(item.values())[0]
+                    if result.get('status', None) == 429:
+                        rejected_li.append(entry)
+                    elif 'error' in result:
+                        failed_li.append((result.get('_id', None), result['error']))
+                    else:
+                        n_ok += 1
+            else:
+                n_ok += len(res['items'])
+            if not rejected_li:
+                self.on_success(latency, len(body))
+                break
+            if attempt == self.max_retries:
+                failed_li.extend([(list(json.loads(entry.split('\n')[0]).values())[0].get('_id', None), 'rejected')
+                                  for entry in rejected_li])
+                break
+            self.on_rejected(len(rejected_li))
+            body = ''.join(rejected_li)
+        return n_ok, failed_li
+
+    def bulk(self, conn, actions, serializer=None):
+        '''send bulk actions (as passed to elasticsearch.helpers.bulk) in
+           adaptively sized requests. return the no. of succeeded actions and a
+           list of (_id, error) of failed actions.
+        '''
+        serializer = serializer or conn.transport.serializer
+        cnt = 0
+        failed_li = []
+        for body, n in iter_bulk_bodies(actions, serializer, max_docs=self.max_docs,
+                                        max_bytes=self.get_bulk_bytes):
+            _cnt, _failed_li = self.send(conn, body)
+            cnt += _cnt
+            failed_li.extend(_failed_li)
+        return cnt, failed_li
+
+
 class ESIndexer(object):
     def __init__(self, es_index_name=None, es_index_type=None, mapping=None, es_host=None, step=5000):
         self.conn = get_es(es_host)
+        self.es_host = es_host
         self.ES_INDEX_NAME = es_index_name or ES_INDEX_NAME
         self.ES_INDEX_TYPE = es_index_type or ES_INDEX_TYPE
         #if self.ES_INDEX_NAME:
@@ -60,6 +421,7 @@ class ESIndexer(object):
         self.s = None   # optionally, can specify number of records to skip,
                         # useful to continue indexing after an error.
         self.use_parallel = False
+        self.index_workers = 4    # no. of local processes used by _build_index_parallel
         self._mapping = mapping
 
     def _get_es_version(self):
@@ -168,20 +530,25 @@ class ESIndexer(object):
         index_type = self.ES_INDEX_TYPE
         return conn.get(index_name, id, index_type, **kwargs)
 
-    def get_docs(self, ids, step=None, **kwargs):
+    def get_docs(self, ids, step=None, fields=None, **kwargs):
         '''return matching docs for given ids, if not found return None.
            A generator is returned and the order is perserved.
+           "fields" is an optional list of fields to return from "_source".
         '''
         conn = self.conn
         index_name = self.ES_INDEX_NAME
         index_type = self.ES_INDEX_TYPE
         step = step or self.step
+        if fields:
+            kwargs['_source_include'] = list(fields)
         for i in range(0, len(ids), step):
             _ids = ids[i:i + step]
             body = {'ids': _ids}
             res = conn.mget(body=body, index=index_name, doc_type=index_type, **kwargs)
             for doc in res['docs']:
                 if doc['found']:
+                    if fields:
+                        doc['_source'].setdefault('_id', doc['_id'])
                     yield doc['_source']
                 else:
                     yield None
@@ -275,6 +642,64 @@ class ESIndexer(object):
         actions = (_get_bulk(doc) for doc in partial_docs)
         return helpers.bulk(self.conn, actions, chunk_size=self.step, **kwargs)
 
+    def update_docs_from_diffs(self, diff_li, extra=None, step=None):
+        '''apply diffs returned from utils.diff.diff_doc (including dotted paths
+           from a deep diff) as partial updates, with bulk "update" actions.
+           If no path is deleted and no object is replaced, "add" and "update"
+           values are sent as a partial doc, with dotted paths expanded into
+           nested objects (ES merges objects recursively). Otherwise, a script
+           sets and removes the paths, since merging would keep the stale
+           fields of a replaced object.
+           "extra" is a dictionary of common fields to set, a "_timestamp" in
+           it also sets the "_timestamp" meta field, as when a doc is indexed.
+           Diffs with deleted paths need SET_UNSET_PATHS_SCRIPT, so they fail
+           if dynamic scripting is disabled, re-index those docs instead.
+           return a list of _ids failed to update, including those of diffs
+           setting values with dotted keys (see get_diff_update_action), which
+           should be re-indexed as full docs.
+        '''
+        step = step or self.step
+        skipped_li = []
+
+        def _actions():
+            for diff in diff_li:
+                action = self.get_diff_update_action(diff, extra=extra)
+                if action is None:
+                    skipped_li.append(diff['_id'])
+                else:
+                    yield action
+        success, errors = helpers.bulk(self.conn, _actions(), chunk_size=step, raise_on_error=False)
+        return sorted(set([list(err.values())[0]['_id'] for err in errors] + skipped_li))
+
+    def get_diff_update_action(self, diff, extra=None):
+        '''return a bulk "update" action for a diff, see update_docs_from_diffs.
+           return None if the diff sets values with dotted keys (see
+           utils.common.diff_has_dotted_key), the doc should be re-indexed.
+        '''
+        if diff_has_dotted_key(diff):
+            return None
+        _doc = {}
+        _doc.update(diff.get('add', {}))
+        _doc.update(diff.get('update', {}))
+        extra = extra or {}
+        timestamp = extra.get('_timestamp', None)     # set in the doc and as the meta field
+        _doc.update(extra)
+        action = {'_op_type': 'update',
+                  '_index': self.ES_INDEX_NAME,
+                  '_type': self.ES_INDEX_TYPE,
+                  '_id': diff['_id']}
+        if diff.get('delete', None) or any([isinstance(v, dict) for v in _doc.values()]):
+            action.update({'script': SET_UNSET_PATHS_SCRIPT,
+                           'lang': 'groovy',
+                           'params': {'sets': _doc, 'unsets': diff.get('delete', []),
+                                      'timestamp': timestamp}})
+        else:
+            if timestamp is not None:
+                # moved into the action metadata by helpers.expand_action
+                action['_timestamp'] = timestamp
+            action['doc'] = _expand_dotted_paths(_doc)
+        return action
+
     def wait_till_all_shards_ready(self, timeout=None, interval=5):
         raise NotImplementedError
 
@@ -312,7 +737,7 @@ class ESIndexer(object):
         try:
             print("Building index...")
             if self.use_parallel:
-                cnt = self._build_index_parallel(collection, verbose)
+                cnt = self._build_index_parallel(collection, verbose, query=query)
             else:
                 cnt = self._build_index_sequential(collection, verbose, query=query, bulk=bulk)
         finally:
@@ -344,24 +769,29 @@ class ESIndexer(object):
             print("Optimizing...", self.optimize())
 
     def _build_index_sequential(self, collection, verbose=False, query=None, bulk=True):
-
-        def rate_control(cnt, t):
-            delay = 0
-            if t > 90:
-                delay = 30
-            elif t > 60:
-                delay = 10
-            if delay:
-                print("\tPausing for {}s...".format(delay), end='')
-                time.sleep(delay)
-                print("done.")
-
-        src_docs = doc_feeder(collection, step=self.step, s=self.s, batch_callback=rate_control, query=query)
+        '''index docs from collection in one process. bulk requests are sized
+           and throttled by an AdaptiveBulkController.
+        '''
+        src_docs = doc_feeder(collection, step=self.step, s=self.s, query=query)
         if bulk:
-            res = self.index_bulk(src_docs)
-            if len(res[1]) > 0:
-                print("Error: {} docs failed indexing.".format(len(res[1])))
-            return res[0]
+            index_name = self.ES_INDEX_NAME
+            doc_type = self.ES_INDEX_TYPE
+
+            def _get_bulk(doc):
+                doc.update({
+                    "_index": index_name,
+                    "_type": doc_type,
+                })
+                return doc
+            controller = AdaptiveBulkController()
+            cnt, failed_li = controller.bulk(self.conn, (_get_bulk(doc) for doc in src_docs))
+            if failed_li:
+                print("Error: {} docs failed indexing.".format(len(failed_li)))
+                if verbose:
+                    print('\n'.join(['\t{}: {}'.format(_id, error) for _id, error in failed_li]))
+            print("{} bulk controller decisions, final bulk size: {}KB".format(len(controller.decisions),
+                                                                               controller.bulk_bytes // 1024))
+            return cnt
         else:
             cnt = 0
             for doc in src_docs:
@@ -371,58 +801,117 @@ class ESIndexer(object):
                     print(cnt, ':', doc['_id'])
             return cnt
 
-    def _build_index_parallel(self, collection, verbose=False):
-        raise NotImplementedError
-        from utils.parallel import (run_jobs_on_ipythoncluster,
-                                    collection_partition,
-                                    require)
-        kwargs_common = {'ES_HOST': ES_HOST,
-                         'ES_INDEX_NAME': self.ES_INDEX_NAME,
-                         'ES_INDEX_TYPE': self.ES_INDEX_TYPE,
-                         }
-        task_list = []
-        for kwargs in collection_partition(collection, step=self.step):
-            kwargs.update(kwargs_common)
-            task_list.append(kwargs)
-
-        @require('mongokit', 'pyes')
-        def worker(kwargs):
-            import mongokit
-            import pyes
-            server = kwargs['server']
-            port = kwargs['port']
-            src_db = kwargs['src_db']
-            src_collection = kwargs['src_collection']
-            skip = kwargs['skip']
-            limit = kwargs['limit']
-
-            mongo_conn = mongokit.Connection(server, port)
-            src = mongo_conn[src_db]
-
-            ES_HOST = kwargs['ES_HOST']
-            ES_INDEX_NAME = kwargs['ES_INDEX_NAME']
-            ES_INDEX_TYPE = kwargs['ES_INDEX_TYPE'],
-
-            es_conn = pyes.ES(ES_HOST, default_indices=[ES_INDEX_NAME],
-                              timeout=120.0, max_retries=10)
-
-            cur = src[src_collection].find(skip=skip, limit=limit, timeout=False)
-            cur.batch_size(1000)
-            cnt = 0
-            try:
-                for doc in cur:
-                    es_conn.index(doc, ES_INDEX_NAME, ES_INDEX_TYPE, doc['_id'], bulk=True)
-                    cnt += 1
-            finally:
-                cur.close()
-            es_conn.indices.flush()   # this is important to avoid missing docs
-            es_conn.indices.refresh()
-            return cnt
-
-        job_results = run_jobs_on_ipythoncluster(worker, task_list)
-        if job_results:
-            cnt = sum(job_results)
-            return cnt
+    def _build_index_parallel(self, collection, verbose=False, query=None):
+        '''index docs from collection using self.index_workers local processes.
+           The collection is split into _id ranges, each worker process opens
+           its own Mongo and ES connections and indexes one range at a time
+           with bulk requests. return the total no. of docs indexed.
+        '''
+        from multiprocessing import Pool
+        t0 = time.time()
+        range_li = id_range_partition(collection, self.index_workers * 4, query=query)
+        task_li = [{'es_host': self.es_host,
+                    'index_name': self.ES_INDEX_NAME,
+                    'index_type': self.ES_INDEX_TYPE,
+                    'db_name': collection.database.name,
+                    'collection': collection.name,
+                    'query': query,
+                    'start': start,
+                    'end': end,
+                    'step': self.step} for (start, end) in range_li]
+        print('indexing {} _id ranges with {} workers...'.format(len(task_li), self.index_workers))
+        cnt = 0
+        failed_li = []
+        pool = Pool(processes=self.index_workers)
+        try:
+            for i, res in enumerate(pool.imap_unordered(_build_index_worker, task_li)):
+                print('\tworker {pid}: [{start}, {end}) {docs_indexed} docs indexed, '
+                      '{docs_failed} failed, final bulk size {bulk_kb}KB [{time}] ({0}/{1})'.format(
+                      i + 1, len(task_li), **res))
+                cnt += res['docs_indexed']
+                failed_li.extend(res['failed'])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if failed_li:
+            print("Error: {} docs failed indexing.".format(len(failed_li)))
+            if verbose:
+                print('\n'.join(['\t{}'.format(_id) for _id in sorted(failed_li)]))
+        print('{} docs indexed [{}]'.format(cnt, timesofar(t0)))
+        return cnt
+
+    def render_bulk_files(self, collection, folder, query=None):
+        '''render docs from collection into gzipped bulk files in folder, which
+           can be sent to any ES host or index later by replay_bulk_files,
+           without reading Mongo or serializing docs again. The collection is
+           split into _id ranges, each rendered into one file by one of
+           self.index_workers local processes. Bulk actions have no "_index"
+           or "_type", and a manifest.json records the files and doc counts.
+        '''
+        from multiprocessing import Pool
+        if os.path.exists(folder):
+            raise ValueError('"{}" already exists.'.format(folder))
+        os.makedirs(folder)
+        t0 = time.time()
+        range_li = id_range_partition(collection, self.index_workers * 4, query=query)
+        task_li = [{'db_name': collection.database.name,
+                    'collection': collection.name,
+                    'query': query,
+                    'start': start,
+                    'end': end,
+                    'step': self.step,
+                    'filename': os.path.join(folder, 'bulk_{:05d}.ndjson.gz'.format(i))}
+                   for i, (start, end) in enumerate(range_li)]
+        print('rendering {} _id ranges with {} workers...'.format(len(task_li), self.index_workers))
+        file_li = []
+        pool = Pool(processes=self.index_workers)
+        try:
+            for i, res in enumerate(pool.imap_unordered(_render_bulk_worker, task_li)):
+                print('\tworker {pid}: [{start}, {end}) {docs} docs rendered [{time}] ({0}/{1})'.format(
+                      i + 1, len(task_li), **res))
+                file_li.append({'filename': os.path.basename(res['filename']),
+                                'docs': res['docs'],
+                                'bytes': res['bytes']})
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        file_li.sort(key=lambda x: x['filename'])
+        manifest = {'source': collection.name,
+                    'query': query,
+                    'docs': sum([x['docs'] for x in file_li]),
+                    'files': file_li,
+                    'created_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(os.path.join(folder, 'manifest.json'), 'w') as out_f:
+            json.dump(manifest, out_f, indent=2)
+        print('{} docs rendered into "{}" [{}]'.format(manifest['docs'], folder, timesofar(t0)))
+        return manifest
+
+    def replay_bulk_files(self, folder, max_workers=4, max_inflight_bytes=50 * 1024 * 1024,
+                          max_bytes=10 * 1024 * 1024):
+        '''send bulk files rendered by render_bulk_files into this index, with a
+           BulkSender of max_workers threads. return the no. of docs indexed.
+        '''
+        with open(os.path.join(folder, 'manifest.json')) as in_f:
+            manifest = json.load(in_f)
+        print('replaying {} docs from {} files of "{}" into "{}"...'.format(
+              manifest['docs'], len(manifest['files']), manifest['source'], self.ES_INDEX_NAME))
+        sender = BulkSender(self.conn, max_workers=max_workers, max_inflight_bytes=max_inflight_bytes,
+                            index=self.ES_INDEX_NAME, doc_type=self.ES_INDEX_TYPE)
+        with sender:
+            for file_d in manifest['files']:
+                for body in iter_bulk_file_bodies(os.path.join(folder, file_d['filename']), max_bytes=max_bytes):
+                    sender.submit(body)
+        if sender.failed:
+            print("Error: {} docs failed indexing.".format(len(sender.failed)))
+        if sender.stats['docs'] != manifest['docs']:
+            print("Warning: {} docs indexed, should be {}.".format(sender.stats['docs'], manifest['docs']))
+        return sender.stats['docs']
 
     def doc_feeder(self, index_type=None, index_name=None, step=10000, verbose=True, query=None, scroll='10m', **kwargs):
         conn = self.conn
@@ -451,58 +940,374 @@ class ESIndexer(object):
             print('done.[%.1f%%,%s]' % (cnt*100./n, timesofar(t1)))
             print("Finished! [{}]".format(timesofar(t0)))
 
+    def sorted_doc_feeder(self, index_type=None, index_name=None, step=10000, verbose=False, query=None,
+                          fields=None, scroll='10m'):
+        '''same as doc_feeder, but docs are returned in _id order, by sorting on
+           "_uid" ("<doc_type>#<_id>") within one doc type. The "_source" of each
+           doc is returned with "_id" added. "fields" is an optional list of
+           fields to return from "_source".
+        '''
+        conn = self.conn
+        index_name = index_name or self.ES_INDEX_NAME
+        doc_type = index_type or self.ES_INDEX_TYPE
+
+        body = dict(query or {'query': {'match_all': {}}})
+        body['sort'] = [{'_uid': {'order': 'asc'}}]
+        _kwargs = {}
+        if fields:
+            _kwargs['_source_include'] = list(fields)
+        elif fields is not None:
+            _kwargs['_source'] = False
+        cnt = 0
+        t0 = time.time()
+        res = conn.search(index=index_name, doc_type=doc_type, body=body, scroll=scroll, size=step, **_kwargs)
+        scroll_id = res.get('_scroll_id', None)
+        try:
+            while res['hits']['hits']:
+                for hit in res['hits']['hits']:
+                    doc = hit.get('_source', {})
+                    doc.setdefault('_id', hit['_id'])
+                    yield doc
+                cnt += len(res['hits']['hits'])
+                if verbose:
+                    print('\t{} docs...[{}]'.format(cnt, timesofar(t0)))
+                res = conn.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    conn.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    pass
+
     def get_id_list(self, index_type=None, index_name=None, step=100000, verbose=True):
         cur = self.doc_feeder(index_type=index_type, index_name=index_name, step=step, fields=[], verbose=verbose)
         id_li = [doc['_id'] for doc in cur]
         return id_li
 
-    def get_id_list_parallel(self, taxid_li, index_type=None, index_name=None, step=1000, verbose=True):
-        '''return a list of all doc ids in an index_type.'''
-        raise NotImplementedError
-        from utils.parallel import run_jobs_on_ipythoncluster
-
-        def _get_ids_worker(args):
-            from utils.es import ESIndexer
-            from pyes import MatchAllQuery
-            es_kwargs, start, step = args
-            q = MatchAllQuery().search()
-            q.sort = [{'entrezgene': 'asc'}, {'ensembl.gene': 'asc'}]
-            q.fields = []
-            q.start = start
-            q.size = step
-            esi = ESIndexer(**es_kwargs)
-            cnt = esi.count()['count']
-            res = esi.conn.search_raw(q)
-            assert res['hits']['total'] == cnt
-            return [doc['_id'] for doc in res['hits']['hits']]
-
-        def _get_ids_worker_by_taxid(args):
-            from utils.es import ESIndexer
-            from pyes import TermQuery
-            es_kwargs, taxid, step = args
-            q = TermQuery()
-            q.add('taxid', taxid)
-            q.fields = []
-            q.size = step
-            esi = ESIndexer(**es_kwargs)
-            res = esi.conn.search(q)
-            xli = [doc['_id'] for doc in res]
-            assert len(xli) == res.total
-            return xli
-
-        es_kwargs = {'es_index_name': self.ES_INDEX_NAME, 'es_host': 'su02:9200'}
-        task_li = [(es_kwargs, taxid, step) for taxid in taxid_li]
-        #print task_li
-        job_results = run_jobs_on_ipythoncluster(_get_ids_worker_by_taxid, task_li)
-        return job_results
+    def get_number_of_shards(self, index_name=None):
+        res = self.conn.indices.get_settings(index=index_name or self.ES_INDEX_NAME)
+        return int(list(res.values())[0]['settings']['index']['number_of_shards'])
+
+    def get_slices(self, n_slices=None, index_name=None):
+        '''return a list of n_slices scroll slices (default to the no. of
+           shards) to read an index in parallel, see scroll_slice. On ES 5+,
+           native sliced scroll is used. On older versions, a slice is a group
+           of shards, read with a "_shards" search preference, so n_slices is
+           no more than the no. of shards.
+        '''
+        n_shards = self.get_number_of_shards(index_name)
+        n_slices = n_slices or n_shards
+        if int(self._get_es_version().split('.')[0]) >= 5:
+            return [{'id': i, 'max': n_slices} for i in range(n_slices)]
+        n_slices = min(n_slices, n_shards)
+        return [{'id': i, 'max': n_slices, 'shards': list(range(i, n_shards, n_slices))}
+                for i in range(n_slices)]
+
+    def scroll_slice(self, slice_d, index_type=None, index_name=None, step=10000, query=None,
+                     fields=None, scroll='10m'):
+        '''yield hits of one slice returned from get_slices. "fields" is an
+           optional list of fields to return from "_source", or [] for none.
+        '''
+        conn = self.conn
+        index_name = index_name or self.ES_INDEX_NAME
+        doc_type = index_type or self.ES_INDEX_TYPE
+        body = dict(query or {'query': {'match_all': {}}})
+        _kwargs = {}
+        if fields:
+            _kwargs['_source_include'] = list(fields)
+        elif fields is not None:
+            _kwargs['_source'] = False
+        if 'shards' in slice_d:
+            _kwargs['search_type'] = 'scan'     # size is per shard for "scan"
+            _kwargs['preference'] = '_shards:' + ','.join([str(x) for x in slice_d['shards']])
+        else:
+            if slice_d['max'] > 1:
+                body['slice'] = {'id': slice_d['id'], 'max': slice_d['max']}
+            body['sort'] = ['_doc']
+        res = conn.search(index=index_name, doc_type=doc_type, body=body, scroll=scroll, size=step, **_kwargs)
+        scroll_id = res.get('_scroll_id', None)
+        try:
+            hits = res['hits']['hits']
+            while True:
+                for hit in hits:
+                    yield hit
+                res = conn.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id', scroll_id)
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+        finally:
+            if scroll_id:
+                try:
+                    conn.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    pass
+
+    def sliced_doc_feeder(self, n_slices=None, index_type=None, index_name=None, step=10000, query=None,
+                          fields=None, scroll='10m', verbose=True):
+        '''same as doc_feeder, but the index is read by n_slices concurrent
+           scroll slices (see get_slices), and their hits are merged in no
+           particular order. If the consumer stops early (or raises), slice
+           threads are stopped and their scroll contexts are cleared.
+        '''
+        slice_li = self.get_slices(n_slices, index_name=index_name)
+        hit_queue = queue.Queue(maxsize=len(slice_li) * 2)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    hit_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _worker(slice_d):
+            hit_iter = self.scroll_slice(slice_d, index_type=index_type, index_name=index_name, step=step,
+                                         query=query, fields=fields, scroll=scroll)
+            try:
+                hit_li = []
+                for hit in hit_iter:
+                    hit_li.append(hit)
+                    if len(hit_li) >= step:
+                        if not _put(hit_li):
+                            return
+                        hit_li = []
+                if hit_li and not _put(hit_li):
+                    return
+                _put(None)
+            except Exception as e:
+                _put(e)
+            finally:
+                hit_iter.close()    # clears the scroll context
+
+        t0 = time.time()
+        if verbose:
+            print('\treading {} slices...'.format(len(slice_li)))
+        thread_li = []
+        for slice_d in slice_li:
+            t = threading.Thread(target=_worker, args=(slice_d,))
+            t.daemon = True
+            t.start()
+            thread_li.append(t)
+        cnt = 0
+        n_done = 0
+        try:
+            while n_done < len(slice_li):
+                hit_li = hit_queue.get()
+                if hit_li is None:
+                    n_done += 1
+                elif isinstance(hit_li, Exception):
+                    raise hit_li
+                else:
+                    for hit in hit_li:
+                        yield hit
+                    cnt += len(hit_li)
+                    if verbose and cnt // step != (cnt - len(hit_li)) // step:
+                        print('\t{} docs...[{}]'.format(cnt, timesofar(t0)))
+        finally:
+            stop.set()
+            while True:
+                try:
+                    hit_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for t in thread_li:
+                t.join()
+        if verbose:
+            print("Finished! {} docs [{}]".format(cnt, timesofar(t0)))
+
+    def get_id_list_parallel(self, n_slices=None, index_type=None, index_name=None, step=10000, query=None,
+                             as_set=False, verbose=True):
+        '''return a list of all doc ids in an index_type (optionally matching
+           "query"), read by n_slices concurrent scroll slices. if as_set is
+           True, a compact utils.idmapping.GeneIdSet is returned instead.
+        '''
+        cur = self.sliced_doc_feeder(n_slices=n_slices, index_type=index_type, index_name=index_name,
+                                     step=step, query=query, fields=[], verbose=verbose)
+        if as_set:
+            id_set = GeneIdSet()
+            for hit in cur:
+                id_set.add(hit['_id'])
+            return id_set
+        return [hit['_id'] for hit in cur]
+
+    def get_index_checksum(self, index_name=None, n_slices=None):
+        '''return (count, checksum) of docs in an index_type, the checksum is
+           the sum of md5 digests of each doc (with its _id), so it does not
+           depend on the order docs are read by sliced scrolls.
+        '''
+        cnt = 0
+        checksum = 0
+        for hit in self.sliced_doc_feeder(n_slices=n_slices, index_name=index_name, verbose=False):
+            doc = dict(hit['_source'])
+            doc['_id'] = hit['_id']
+            checksum = (checksum + int(get_doc_hash(doc, exclude_attrs=())[:16], 16)) % 2 ** 64
+            cnt += 1
+        return cnt, checksum
 
     def clone_index(self, src_index, target_index, target_es_host=None, step=10000, scroll='10m',
-                    target_index_settings=None, number_of_shards=None):
+                    target_index_settings=None, number_of_shards=None, n_slices=None,
+                    max_workers=4, progress_file=None, verify=True):
         '''clone src_index to target_index on the same es_host, or another one given
-           by target_es_host.
-
-           This method can now be replaced by helpers.reindex
+           by target_es_host. Docs of self.ES_INDEX_TYPE are read by n_slices
+           concurrent sliced scrolls (see get_slices), and written by a
+           BulkSender of max_workers threads. target_index is created with the
+           mappings of src_index, refresh and replicas are disabled during the
+           copy, and restored (or set from target_index_settings) afterwards.
+
+           Slices copied without errors are recorded in progress_file (default
+           to "clone_<src_index>_<target_index>.json"), calling clone_index
+           again after an interruption copies only the remaining slices.
+           if verify is True, doc counts and checksums (see get_index_checksum)
+           of both indices are compared at the end.
         '''
+        t0 = time.time()
+        target_esi = ESIndexer(target_index, es_index_type=self.ES_INDEX_TYPE,
+                               es_host=target_es_host or self.es_host, step=step)
+        target_conn = target_esi.conn
+        progress_file = progress_file or 'clone_{}_{}.json'.format(src_index, target_index)
+        src_settings = list(self.conn.indices.get_settings(index=src_index).values())[0]['settings']['index']
+        if os.path.exists(progress_file):
+            with open(progress_file) as in_f:
+                progress = json.load(in_f)
+            print('Resuming from "{}": {}/{} slices done.'.format(progress_file, len(progress['done']),
+                                                                 len(progress['slices'])))
+        else:
+            if target_conn.indices.exists(target_index):
+                raise ValueError('target index "{}" already exists.'.format(target_index))
+            mapping = list(self.conn.indices.get_mapping(index=src_index).values())[0]['mappings']
+            body = {'settings': {'number_of_shards': number_of_shards or int(src_settings['number_of_shards']),
+                                 'number_of_replicas': 0,
+                                 'refresh_interval': '-1'},
+                    'mappings': mapping}
+            print(target_conn.indices.create(index=target_index, body=body))
+            progress = {'src_index': src_index,
+                        'target_index': target_index,
+                        'slices': self.get_slices(n_slices, index_name=src_index),
+                        'done': []}
+            with open(progress_file, 'w') as out_f:
+                json.dump(progress, out_f, indent=2)
+        target_conn.indices.put_settings({'index': {'refresh_interval': '-1', 'number_of_replicas': 0}},
+                                         target_index)
+
+        progress_lock = threading.Lock()
+        serializer = target_conn.transport.serializer
+        sender = BulkSender(target_conn, max_workers=max_workers)
+
+        def _copy_slice(slice_d):
+            hits = self.scroll_slice(slice_d, index_name=src_index, step=step, scroll=scroll)
+            actions = ({'_index': target_index,
+                        '_type': hit['_type'],
+                        '_id': hit['_id'],
+                        '_source': hit['_source']} for hit in hits)
+            future_li = [sender.submit(body) for body, n in iter_bulk_bodies(actions, serializer, max_docs=step)]
+            n_failed = sum([f.result() for f in future_li])
+            if n_failed == 0:
+                with progress_lock:
+                    progress['done'].append(slice_d['id'])
+                    with open(progress_file, 'w') as out_f:
+                        json.dump(progress, out_f, indent=2)
+            print('\tslice {}: {} bulk requests, {} failed.'.format(slice_d['id'], len(future_li), n_failed))
+            return n_failed
+
+        slice_li = [slice_d for slice_d in progress['slices'] if slice_d['id'] not in progress['done']]
+        print('Cloning {} slices of "{}" into "{}"...'.format(len(slice_li), src_index, target_index))
+        try:
+            with ThreadPoolExecutor(max_workers=len(slice_li) or 1) as executor:
+                n_failed = sum(executor.map(_copy_slice, slice_li))
+        finally:
+            sender.close()
+            settings = {'refresh_interval': src_settings.get('refresh_interval', '1s'),    # ES default
+                        'number_of_replicas': int(src_settings.get('number_of_replicas', 0))}
+            if target_index_settings:
+                settings.update(target_index_settings)
+            target_conn.indices.put_settings({'index': settings}, target_index)
+            target_conn.indices.refresh(target_index)
+        if n_failed:
+            print('Error: {} docs failed, run clone_index again to retry the failed slices.'.format(n_failed))
+            return False
+        os.remove(progress_file)
+        print('Done. [{}]'.format(timesofar(t0)))
+
+        if verify:
+            print("Verifying counts and checksums...", end='')
+            src_res = self.get_index_checksum(index_name=src_index)
+            target_res = target_esi.get_index_checksum()
+            if src_res == target_res:
+                print('OK [{} docs, checksum {:x}]'.format(*src_res))
+            else:
+                print('ERROR!!!\n\t{} docs, checksum {:x} in "{}", but {} docs, checksum {:x} in "{}"'.format(
+                      src_res[0], src_res[1], src_index, target_res[0], target_res[1], target_index))
+                return False
+        return True
+
+
+_index_worker_conn = None    # Mongo connection opened by each _build_index_worker process
+
+
+def _build_index_worker(kwargs):
+    '''index one _id range of a collection, run in a worker process.'''
+    global _index_worker_conn
+    t0 = time.time()
+    if _index_worker_conn is None:
+        _index_worker_conn = get_src_conn()
+    es = get_es(kwargs['es_host'])
+    collection = _index_worker_conn[kwargs['db_name']][kwargs['collection']]
+    cur = collection.find(id_range_query(kwargs['start'], kwargs['end'], kwargs['query']), timeout=False)
+    cur.batch_size(kwargs['step'])
+
+    def _get_bulk(doc):
+        doc.update({'_index': kwargs['index_name'],
+                    '_type': kwargs['index_type']})
+        return doc
+    # bulk requests of each worker are sized and throttled by its own controller
+    controller = AdaptiveBulkController(max_docs=kwargs['step'])
+    try:
+        cnt, errors = controller.bulk(es, (_get_bulk(doc) for doc in cur))
+    finally:
+        cur.close()
+    failed_li = [_id for _id, error in errors]
+    return {'pid': os.getpid(),
+            'start': kwargs['start'],
+            'end': kwargs['end'],
+            'docs_indexed': cnt,
+            'docs_failed': len(failed_li),
+            'failed': failed_li,
+            'bulk_kb': controller.bulk_bytes // 1024,
+            'time': timesofar(t0)}
+
+
+def _render_bulk_worker(kwargs):
+    '''render one _id range of a collection into a bulk file, run in a worker process.'''
+    global _index_worker_conn
+    t0 = time.time()
+    if _index_worker_conn is None:
+        _index_worker_conn = get_src_conn()
+    serializer = JSONSerializer()
+    collection = _index_worker_conn[kwargs['db_name']][kwargs['collection']]
+    cur = collection.find(id_range_query(kwargs['start'], kwargs['end'], kwargs['query']), timeout=False)
+    cur.batch_size(kwargs['step'])
+    cnt = 0
+    out_f = gzip.GzipFile(kwargs['filename'], 'wb')
+    try:
+        for doc in cur:
+            # the same action and source as sent by helpers.bulk in build_index
+            action, data = helpers.expand_action(doc)
+            out_f.write((serializer.dumps(action) + '\n' + serializer.dumps(data) + '\n').encode('utf-8'))
+            cnt += 1
+    finally:
+        out_f.close()
+        cur.close()
+    return {'pid': os.getpid(),
+            'start': kwargs['start'],
+            'end': kwargs['end'],
+            'filename': kwargs['filename'],
+            'docs': cnt,
+            'bytes': os.path.getsize(kwargs['filename']),
+            'time': timesofar(t0)}
 
 
 def es_clean_indices(keep_last=2, es_host=None, verbose=True, noconfirm=False, dryrun=False):
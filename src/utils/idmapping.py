@@ -0,0 +1,282 @@
+'''
+Compact, array-backed data structures for id conversion and root gene id
+lookups during databuild.
+'''
+from __future__ import print_function
+import os
+import os.path
+import mmap
+import struct
+import tempfile
+from array import array
+
+from utils.common import is_str
+
+
+def _to_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if not is_str(key):
+        key = str(key)
+    return key.encode('utf-8')
+
+
+class IdMapping(object):
+    '''A read-only mapping from string ids (e.g. Ensembl gene ids) to one or more
+       integer ids (e.g. Entrez gene ids), stored in a local file and accessed
+       via mmap, so that multiple processes share the same pages zero-copy.
+
+       File layout (all integers are little-endian 8-byte):
+           magic, n_keys, n_values
+           key_offsets[n_keys+1]     offsets of each key in key_blob
+           value_offsets[n_keys+1]   offsets of the values of each key in values
+           values[n_values]          signed integer values
+           key_blob                  utf-8 encoded keys, sorted
+
+       Lookup is a binary search over sorted keys, no per-entry Python objects
+       are created. Like the dictionary returned from utils.dataload.list2dict,
+       get() returns a single value, or a list when a key has multiple values.
+
+           IdMapping.build(ensembl2entrez_li, 'ensembl2entrez.idmap')
+           idmap = IdMapping('ensembl2entrez.idmap')
+           idmap.get('ENSG00000141510')
+    '''
+    MAGIC = b'IDMAP001'
+    HEADER = struct.Struct('<8sQQ')
+    INT = struct.Struct('<Q')
+    VALUE = struct.Struct('<q')
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as in_f:
+            self._mm = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_keys, self.n_values = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError('"{}" is not a valid idmapping file.'.format(filename))
+        self._key_offsets_pos = self.HEADER.size
+        self._value_offsets_pos = self._key_offsets_pos + (self.n_keys + 1) * 8
+        self._values_pos = self._value_offsets_pos + (self.n_keys + 1) * 8
+        self._key_blob_pos = self._values_pos + self.n_values * 8
+
+    @classmethod
+    def build(cls, pairs, filename):
+        '''write (key, value) pairs into an idmapping file and return an
+           IdMapping instance for it. values of the same key keep their input
+           order. The file is written to a temp file first and then renamed,
+           so processes having the old file mapped are not affected.
+        '''
+        value_d = {}
+        for key, value in pairs:
+            value_d.setdefault(_to_bytes(key), []).append(int(value))
+        key_li = sorted(value_d)
+
+        out_dir = os.path.dirname(os.path.abspath(filename))
+        fd, tmpfile = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out_f:
+                n_values = sum([len(v) for v in value_d.values()])
+                out_f.write(cls.HEADER.pack(cls.MAGIC, len(key_li), n_values))
+                offset = 0
+                for key in key_li:
+                    out_f.write(cls.INT.pack(offset))
+                    offset += len(key)
+                out_f.write(cls.INT.pack(offset))
+                offset = 0
+                for key in key_li:
+                    out_f.write(cls.INT.pack(offset))
+                    offset += len(value_d[key])
+                out_f.write(cls.INT.pack(offset))
+                for key in key_li:
+                    for value in value_d[key]:
+                        out_f.write(cls.VALUE.pack(value))
+                for key in key_li:
+                    out_f.write(key)
+            os.rename(tmpfile, filename)
+        except:
+            os.remove(tmpfile)
+            raise
+        return cls(filename)
+
+    def __reduce__(self):
+        # pickled (e.g. sent to a worker process) as its filename only,
+        # the receiving process maps the same file again.
+        return (self.__class__, (self.filename,))
+
+    def __len__(self):
+        return self.n_keys
+
+    def _offset(self, pos, i):
+        return self.INT.unpack_from(self._mm, pos + i * 8)[0]
+
+    def _key_at(self, i):
+        start = self._key_blob_pos + self._offset(self._key_offsets_pos, i)
+        end = self._key_blob_pos + self._offset(self._key_offsets_pos, i + 1)
+        return self._mm[start:end]
+
+    def _values_at(self, i):
+        start = self._offset(self._value_offsets_pos, i)
+        end = self._offset(self._value_offsets_pos, i + 1)
+        return [self.VALUE.unpack_from(self._mm, self._values_pos + j * 8)[0]
+                for j in range(start, end)]
+
+    def _find(self, key):
+        '''return the index of key, or -1 if not found.'''
+        key = _to_bytes(key)
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_keys and self._key_at(lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i == -1:
+            return default
+        values = self._values_at(i)
+        return values[0] if len(values) == 1 else values
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        values = self._values_at(i)
+        return values[0] if len(values) == 1 else values
+
+    def items(self):
+        '''iterate all (key, value) pairs, value is the same as returned by get().'''
+        for i in range(self.n_keys):
+            values = self._values_at(i)
+            yield self._key_at(i).decode('utf-8'), values[0] if len(values) == 1 else values
+
+    def todict(self):
+        return dict(self.items())
+
+    def close(self):
+        self._mm.close()
+
+
+class GeneIdSet(object):
+    '''A compact membership set for root gene ids. Integer ids (Entrez gene ids,
+       either int or canonical numeric strings) are kept in a bitmap, all
+       other ids (e.g. Ensembl gene ids) in a sorted array of utf-8 strings.
+
+           geneid_set = GeneIdSet(['1017', 1018, 'ENSG00000268895'])
+           '1018' in geneid_set   # True
+    '''
+    def __init__(self, id_li=None):
+        self._bitmap = bytearray()
+        self._int_cnt = 0
+        self._str_blob = b''
+        self._str_offsets = array('L', [0])
+        self._str_pending = []
+        if id_li:
+            self.update(id_li)
+
+    @staticmethod
+    def _as_int(id):
+        if isinstance(id, int):
+            return id if id >= 0 else None
+        if is_str(id) and id.isdigit() and (id == '0' or id[0] != '0'):
+            return int(id)
+
+    def add(self, id):
+        n = self._as_int(id)
+        if n is None:
+            self._str_pending.append(_to_bytes(id))
+        else:
+            idx = n >> 3
+            if idx >= len(self._bitmap):
+                self._bitmap.extend(bytearray(max(idx + 1 - len(self._bitmap), len(self._bitmap))))
+            mask = 1 << (n & 7)
+            if not self._bitmap[idx] & mask:
+                self._bitmap[idx] |= mask
+                self._int_cnt += 1
+
+    def update(self, id_li):
+        for id in id_li:
+            self.add(id)
+
+    def _str_at(self, i):
+        return self._str_blob[self._str_offsets[i]:self._str_offsets[i + 1]]
+
+    def _iter_str(self):
+        for i in range(len(self._str_offsets) - 1):
+            yield self._str_at(i)
+
+    def _compact(self):
+        '''merge pending string ids into the sorted string array.'''
+        if self._str_pending:
+            str_li = sorted(set(self._str_pending) | set(self._iter_str()))
+            self._str_offsets = array('L', [0])
+            offset = 0
+            for s in str_li:
+                offset += len(s)
+                self._str_offsets.append(offset)
+            self._str_blob = b''.join(str_li)
+            self._str_pending = []
+
+    def __contains__(self, id):
+        n = self._as_int(id)
+        if n is None:
+            self._compact()
+            key = _to_bytes(id)
+            lo, hi = 0, len(self._str_offsets) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._str_at(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo < len(self._str_offsets) - 1 and self._str_at(lo) == key
+        else:
+            idx = n >> 3
+            return idx < len(self._bitmap) and bool(self._bitmap[idx] & (1 << (n & 7)))
+
+    def __len__(self):
+        self._compact()
+        return self._int_cnt + len(self._str_offsets) - 1
+
+    def __iter__(self):
+        '''iterate all ids as strings, integer ids first.'''
+        self._compact()
+        for idx, byte in enumerate(self._bitmap):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield str(idx * 8 + bit)
+        for s in self._iter_str():
+            yield s.decode('utf-8')
+
+    def __getstate__(self):
+        self._compact()
+        return {'bitmap': bytes(self._bitmap),
+                'int_cnt': self._int_cnt,
+                'str_blob': self._str_blob,
+                'str_offsets': _array_tobytes(self._str_offsets)}
+
+    def __setstate__(self, state):
+        self._bitmap = bytearray(state['bitmap'])
+        self._int_cnt = state['int_cnt']
+        self._str_blob = state['str_blob']
+        self._str_offsets = array('L')
+        _array_frombytes(self._str_offsets, state['str_offsets'])
+        self._str_pending = []
+
+
+def _array_tobytes(arr):
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def _array_frombytes(arr, s):
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(s)
+    else:
+        arr.fromstring(s)
@@ -1,5 +1,7 @@
 from __future__ import print_function
 import time
+import bisect
+import numbers
 from mongokit import Connection
 from config import (DATA_SRC_SERVER, DATA_SRC_PORT, DATA_SRC_DATABASE,
                     DATA_SRC_MASTER_COLLECTION, DATA_SRC_DUMP_COLLECTION,
@@ -7,7 +9,7 @@ from config import (DATA_SRC_SERVER, DATA_SRC_PORT, DATA_SRC_DATABASE,
                     DATA_SERVER_USERNAME, DATA_SERVER_PASSWORD,
                     DATA_TARGET_SERVER, DATA_TARGET_PORT, DATA_TARGET_DATABASE,
                     DATA_TARGET_MASTER_COLLECTION)
-from utils.common import timesofar
+from utils.common import timesofar, is_str
 
 
 def get_conn(server, port):
@@ -74,14 +76,17 @@ def doc_feeder0(collection, step=1000, s=None, e=None, inbatch=False):
         print('Done.[%s]' % timesofar(t0))
 
 
-def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None, batch_callback=None, fields=None):
+def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None, batch_callback=None, fields=None, sort=None):
     '''A iterator for returning docs in a collection, with batch query.
        additional filter query can be passed via "query", e.g.,
        doc_feeder(collection, query={'taxid': {'$in': [9606, 10090, 10116]}})
        batch_callback is a callback function as fn(cnt, t), called after every batch
        fields is optional parameter passed to find to restrict fields to return.
+       sort is optional parameter passed to cursor.sort, e.g. [('_id', 1)]
     '''
     cur = collection.find(query, timeout=False, fields=fields)
+    if sort:
+        cur.sort(sort)
     n = cur.count()
     s = s or 0
     e = e or n
@@ -128,6 +133,89 @@ def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None,
         cur.close()
 
 
+def doc_feeder_by_ids(collection, id_li, step=1000, start_after=None):
+    '''A iterator for returning docs in a collection matching the given _ids,
+       querying "step" _ids at a time with "$in". id_li should be sorted, so
+       that docs are returned in _id order (as doc_feeder with sort=[('_id', 1)]).
+       If "start_after" is given, only docs with _id > start_after are returned.
+    '''
+    if start_after is not None:
+        id_li = id_li[bisect.bisect_right(id_li, start_after):]
+    n = len(id_li)
+    print('Retrieving docs matching %d ids from database "%s".' % (n, collection.name))
+    t0 = time.time()
+    for i in range(0, n, step):
+        print("Processing %d-%d ids..." % (i + 1, min(i + step, n)), end='')
+        t1 = time.time()
+        cur = collection.find({'_id': {'$in': id_li[i:i + step]}}, timeout=False).sort('_id', 1)
+        try:
+            for doc in cur:
+                yield doc
+        finally:
+            cur.close()
+        print('Done.[%.1f%%,%s]' % (min(i + step, n) * 100. / n, timesofar(t1)))
+    print("=" * 20)
+    print('Finished.[total time: %s]' % timesofar(t0))
+
+
+def _id_type_bracket(_id):
+    '''return the group of types compared with each other in _id range queries.'''
+    if isinstance(_id, numbers.Number) and not isinstance(_id, bool):
+        return 'number'
+    elif is_str(_id):
+        return 'string'
+    return type(_id).__name__
+
+
+def id_range_partition(collection, n, query=None):
+    '''split docs in a collection (optionally filtered by "query") into n
+       _id ranges of about the same size. return a list of (start, end) tuples,
+       start is inclusive and end is exclusive, None means unbounded.
+       e.g. [(None, u'2741'), (u'2741', u'5577'), (u'5577', None)]
+       Since range queries only match _ids of the same type as the bounds,
+       one unbounded range is returned if _ids are of mixed types, and the
+       total count of all ranges is checked against the count of docs.
+    '''
+    cnt = collection.find(query).count()
+    size = cnt // n
+    boundary_li = []
+    if size > 0:
+        # _ids are sorted by type first, so the first and the last _id
+        # have the same type only if all _ids have.
+        first_li = [doc['_id'] for doc in collection.find(query, fields=[]).sort('_id', 1).limit(1)]
+        last_li = [doc['_id'] for doc in collection.find(query, fields=[]).sort('_id', -1).limit(1)]
+        if _id_type_bracket(first_li[0]) != _id_type_bracket(last_li[0]):
+            print('"{}" has _ids of mixed types ({!r}...{!r}), not partitioned.'.format(
+                  collection.name, first_li[0], last_li[0]))
+            return [(None, None)]
+        for i in range(1, n):
+            cur = collection.find(query, fields=[]).sort('_id', 1).skip(i * size).limit(1)
+            boundary_li.extend([doc['_id'] for doc in cur])
+            cur.close()
+    boundary_li = [None] + boundary_li + [None]
+    range_li = list(zip(boundary_li[:-1], boundary_li[1:]))
+    if len(range_li) > 1:
+        _cnt = sum([collection.find(id_range_query(start, end, query)).count() for start, end in range_li])
+        assert _cnt == cnt, \
+            'Abort. _id ranges of "{}" match {} docs, instead of {}.'.format(collection.name, _cnt, cnt)
+    return range_li
+
+
+def id_range_query(start=None, end=None, query=None):
+    '''return a query for docs with start <= _id < end, combined with optional "query".'''
+    _range = {}
+    if start is not None:
+        _range['$gte'] = start
+    if end is not None:
+        _range['$lt'] = end
+    if not _range:
+        return query
+    if query:
+        return {'$and': [query, {'_id': _range}]}
+    else:
+        return {'_id': _range}
+
+
 def src_clean_archives(keep_last=1, src=None, verbose=True, noconfirm=False):
     '''clean up archive collections in src db, only keep last <kepp_last>
        number of archive.